@@ -1,16 +1,31 @@
 import datetime
+import functools
 import hashlib
 import json
 import logging
 import os
 import re
+import signal
+import threading
+import time
 import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from optparse import OptionParser
 from typing import Any, List, Optional, Union
 
-from scoring import get_interests, get_score
-from store import RedisAsStorage
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from scoring import get_interests_many, get_score, get_scores_many
+from store import CachedStorage, FailFastStorage, RedisAsStorage
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -38,30 +53,57 @@ GENDERS = {
 }
 EMPTY_VALUES = ("", [], (), {})
 PENSION_AGE = 65
+# threads serving requests in every process and accepted connections waiting for them
+THREADS = 16
+QUEUE_SIZE = 64
+# Ctrl+C and `kill` stop the server and its workers
+STOP_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+# (account, login) pairs with a memoized token digest
+AUTH_CACHE_SIZE = 10000
+# argument sets scored by one online_score_batch request at most
+MAX_BATCH_SIZE = 1000
+PERSONAL_FIELDS_ERROR = (
+    "At least one pair of fields must be defined (phone + email) "
+    "or (first_name  + last_name ) or (birthday + gender)"
+)
+# Redis socket timeout and retries in the server, scoring must not wait for a dead Redis
+STORE_TIMEOUT = 0.5
+STORE_RETRIES = 1
+JSON_BACKENDS = ("auto", "orjson", "ujson", "json")
 
 
 email_pattern = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
 phone_pattern = re.compile(r"7(\d{10})$")
+# "%d.%m.%Y" with ASCII digits only: unlike strptime, no whitespace before
+# the numbers is skipped; datetime.date checks the ranges
+date_pattern = re.compile(r"([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4})")
 
 
+# Every validate below does all checks of its field in one flat method
+# instead of a chain of super() calls, fields are checked per request
 class Field:
     def __init__(
         self, required: Optional[bool] = False, nullable: Optional[bool] = False
     ) -> None:
         self.required = required
         self.nullable = nullable
+        self.required_error = "{} field is required!".format(self.__class__.__name__)
+        self.nullable_error = "{} field is not nullable".format(self.__class__.__name__)
 
-    def validate(self, value: Any) -> Any:
+    def check_presence(self, value: Any) -> None:
         if self.required and value is None:
-            raise ValueError("{} field is required!".format(self.__class__.__name__))
+            raise ValueError(self.required_error)
         if not self.nullable and value in EMPTY_VALUES:
-            raise ValueError("{} field is not nullable".format(self.__class__.__name__))
+            raise ValueError(self.nullable_error)
+
+    def validate(self, value: Any) -> Any:
+        self.check_presence(value)
         return value
 
 
 class CharField(Field):
     def validate(self, value: str) -> str:
-        super().validate(value)
+        self.check_presence(value)
         if not isinstance(value, str):
             raise TypeError("The field must be a string")
         return value
@@ -69,7 +111,7 @@ class CharField(Field):
 
 class ArgumentsField(Field):
     def validate(self, value: dict) -> dict:
-        super().validate(value)
+        self.check_presence(value)
         if not isinstance(value, dict):
             raise TypeError("The field must be a dict")
         return value
@@ -77,8 +119,10 @@ class ArgumentsField(Field):
 
 class EmailField(CharField):
     def validate(self, value: str) -> str:
-        super().validate(value)
-        if not re.match(email_pattern, value):
+        self.check_presence(value)
+        if not isinstance(value, str):
+            raise TypeError("The field must be a string")
+        if not email_pattern.match(value):
             raise ValueError("The email address isn't correct")
         return value
 
@@ -89,8 +133,8 @@ class PhoneField(Field):
             raise TypeError("The phone number value should be a string or an integer")
 
         value = str(value)
-        super().validate(value)
-        if not re.match(phone_pattern, value):
+        self.check_presence(value)
+        if not phone_pattern.match(value):
             raise ValueError(
                 "The phone number isn't correct (should start with 7 and has length 11)"
             )
@@ -98,20 +142,28 @@ class PhoneField(Field):
 
 
 class DateField(CharField):
-    def validate(self, value: str) -> str:
-        super().validate(value)
+    def parse(self, value: str) -> datetime.date:
+        self.check_presence(value)
+        if not isinstance(value, str):
+            raise TypeError("The field must be a string")
+        match = date_pattern.fullmatch(value)
         try:
-            datetime.datetime.strptime(value, "%d.%m.%Y")
+            if match is None:
+                raise ValueError
+            day, month, year = match.groups()
+            return datetime.date(int(year), int(month), int(day))
         except ValueError:
             raise ValueError("Incorrect date! The date format is %d.%m.%Y ")
+
+    def validate(self, value: str) -> str:
+        self.parse(value)
         return value
 
 
 class BirthDayField(DateField):
     def validate(self, value: str) -> str:
-        super().validate(value)
-        date = datetime.datetime.strptime(value, "%d.%m.%Y")
-        age = datetime.datetime.now().year - date.year
+        date = self.parse(value)
+        age = datetime.date.today().year - date.year
         if age < 0 or age > PENSION_AGE:
             raise ValueError("Age should be in range 0 < age <= PENSION_AGE")
         return value
@@ -122,7 +174,7 @@ class GenderField(Field):
         if not isinstance(value, int):
             raise TypeError("GenderField should be a integer")
 
-        super().validate(value)
+        self.check_presence(value)
         if value not in GENDERS:
             raise ValueError("The gender field must be an integer value - 0, 1 or 2")
         return value
@@ -130,36 +182,80 @@ class GenderField(Field):
 
 class ClientIDsField(Field):
     def validate(self, value: List[int]) -> List[int]:
-        super().validate(value)
+        self.check_presence(value)
         if not isinstance(value, list):
-            raise ValueError("The gender field should be list")
+            raise ValueError("The client_ids field should be list")
         for item in value:
             if not isinstance(item, int):
                 raise ValueError("The client_ids field should be list of integers")
         return value
 
 
+class ArgumentsListField(Field):
+    def validate(self, value: List[dict]) -> List[dict]:
+        self.check_presence(value)
+        if not isinstance(value, list):
+            raise TypeError("The field must be a list")
+        if len(value) > MAX_BATCH_SIZE:
+            raise ValueError("The list can't be longer than {}".format(MAX_BATCH_SIZE))
+        for item in value:
+            if not isinstance(item, dict):
+                raise TypeError("The field must be a list of dicts")
+        return value
+
+
+def compile_request_methods(fields):
+    """Generates __init__ and validate of a request class with its fields.
+
+    The code is unrolled per field, e.g. for a required `login` and an
+    optional `account` validate is
+
+        def validate(self):
+            check_login(self.login)
+            value = self.account
+            if value is not None:
+                check_account(value)
+    """
+    namespace = {"check_" + name: field.validate for name, field in fields.items()}
+    init = ["def __init__(self, **kwargs):", "    get = kwargs.get"]
+    init += ["    self.{0} = get({0!r})".format(name) for name in fields]
+    validate = ["def validate(self):", "    pass"]
+    for name, field in fields.items():
+        if field.required:
+            validate.append("    check_{0}(self.{0})".format(name))
+        else:
+            validate.append("    value = self.{0}".format(name))
+            validate.append("    if value is not None:")
+            validate.append("        check_{0}(value)".format(name))
+    exec("\n".join(init + [""] + validate), namespace)
+    return namespace["__init__"], namespace["validate"]
+
+
 class RequestFields(type):
+    """Collects the Field attributes of a request class into `_fields`.
+
+    Fields of the base classes come first, a field declared again replaces
+    the inherited one. New fields become __slots__ of the instances,
+    __init__ and validate are generated once per class by
+    compile_request_methods.
+    """
+
     def __new__(meta, name, bases, attrs):
         fields = {}
-        for key, value in attrs.items():
+        for base in reversed(bases):
+            fields.update(getattr(base, "_fields", {}))
+        inherited = set(fields)
+        for key, value in list(attrs.items()):
             if isinstance(value, Field):
-                fields[key] = value
+                fields[key] = attrs.pop(key)
         attrs["_fields"] = fields
+        attrs["__slots__"] = tuple(key for key in fields if key not in inherited)
+        attrs["__init__"], attrs["validate"] = compile_request_methods(fields)
         return type.__new__(meta, name, bases, attrs)
 
 
 class Request(metaclass=RequestFields):
-    def __init__(self, **kwargs):
-        for attribute in self._fields:
-            value = kwargs.get(attribute)
-            setattr(self, attribute, value)
-
-    def validate(self):
-        for attribute, field in self._fields.items():
-            value = getattr(self, attribute)
-            if value is not None or field.required:
-                field.validate(value)
+    pass
 
 
 class MethodRequest(Request):
@@ -174,12 +270,12 @@ class MethodRequest(Request):
         return self.login == ADMIN_LOGIN
 
 
-class ClientsInterestsRequest(MethodRequest):
+class ClientsInterestsRequest(Request):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
 
 
-class OnlineScoreRequest(MethodRequest):
+class OnlineScoreRequest(Request):
     first_name = CharField(required=False, nullable=True)
     last_name = CharField(required=False, nullable=True)
     email = EmailField(required=False, nullable=True)
@@ -198,47 +294,109 @@ class OnlineScoreRequest(MethodRequest):
         return False
 
 
+class OnlineScoreBatchRequest(Request):
+    items = ArgumentsListField(required=True)
+
+
+@functools.lru_cache(maxsize=AUTH_CACHE_SIZE)
+def get_user_digest(account, login):
+    msg = account + login + SALT
+    return hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+
+
+# (valid until, digest) of the admin token of the current hour
+admin_token = (0.0, None)
+
+
+def get_admin_digest():
+    global admin_token
+    expires, digest = admin_token
+    now = time.time()
+    if now >= expires:
+        local = time.localtime(now)
+        msg = time.strftime("%Y%m%d%H", local) + ADMIN_SALT
+        digest = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+        hour_start = int(now) - local.tm_min * 60 - local.tm_sec
+        # one tuple, so that threads never see a digest with a wrong expiry
+        admin_token = (hour_start + 60 * 60, digest)
+    return digest
+
+
 def check_auth(request):
     if request.is_admin:
-        msg = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
-        digest = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+        digest = get_admin_digest()
     else:
-        msg = request.account + request.login + SALT
-        digest = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        digest = get_user_digest(request.account, request.login)
+    return digest == request.token
+
+
+def validate_online_score(arguments):
+    """Returns (OnlineScoreRequest, None) or (None, error message)"""
+    try:
+        r = OnlineScoreRequest(**arguments)
+        r.validate()
+    except (ValueError, TypeError) as err:
+        return None, str(err)
+    if not r.validate_personal_fields:
+        return None, PERSONAL_FIELDS_ERROR
+    return r, None
+
+
+def personal_fields(r):
+    return {
+        "phone": r.phone,
+        "email": r.email,
+        "birthday": r.birthday,
+        "gender": r.gender,
+        "first_name": r.first_name,
+        "last_name": r.last_name,
+    }
 
 
 def online_score_handler(request, context, store):
     if request.is_admin:
         return {"score": 42}, OK
 
+    r, error = validate_online_score(request.arguments)
+    if error:
+        return {"code": INVALID_REQUEST, "error": error}, INVALID_REQUEST
+
+    context["has"] = list(request.arguments.keys())
+
+    score = get_score(store=store, **personal_fields(r))
+    return {"score": score}, OK
+
+
+def online_score_batch_handler(request, context, store):
+    """Scores every argument set of `items` like online_score does.
+
+    The response has a result per item in the same order: {"score": ...}
+    or an error of an invalid item. Cached scores are read in one round
+    trip to the store and the computed ones are written in another.
+    """
     try:
-        r = OnlineScoreRequest(**request.arguments)
+        r = OnlineScoreBatchRequest(**request.arguments)
         r.validate()
     except (ValueError, TypeError) as err:
         error = {"code": INVALID_REQUEST, "error": str(err)}
         return error, INVALID_REQUEST
 
-    if not r.validate_personal_fields:
-        return {
-            "code": INVALID_REQUEST,
-            "error": "At least one pair of fields must be defined (phone + email) or (first_name  + last_name ) or (birthday + gender)",
-        }, INVALID_REQUEST
-
-    context["has"] = list(request.arguments.keys())
-
-    score = get_score(
-        store=store,
-        phone=r.phone,
-        email=r.email,
-        birthday=r.birthday,
-        gender=r.gender,
-        first_name=r.first_name,
-        last_name=r.last_name,
-    )
-    return {"score": score}, OK
+    context["nitems"] = len(r.items)
+    if request.is_admin:
+        return {"scores": [{"score": 42} for _ in r.items]}, OK
+
+    results = []
+    people = []
+    for arguments in r.items:
+        item, error = validate_online_score(arguments)
+        if error:
+            results.append({"code": INVALID_REQUEST, "error": error})
+        else:
+            results.append(None)
+            people.append(personal_fields(item))
+    scores = iter(get_scores_many(store, people))
+    results = [result or {"score": next(scores)} for result in results]
+    return {"scores": results}, OK
 
 
 def clients_interests_handler(request, context, store):
@@ -251,9 +409,7 @@ def clients_interests_handler(request, context, store):
 
     context["nclients"] = len(r.client_ids)
 
-    interests = {}
-    for client_id in r.client_ids:
-        interests[client_id] = get_interests(store, client_id)
+    interests = get_interests_many(store, r.client_ids)
     return interests, OK
 
 
@@ -262,6 +418,7 @@ def method_handler(request, context, store):
     method = {
         "online_score": online_score_handler,
         "clients_interests": clients_interests_handler,
+        "online_score_batch": online_score_batch_handler,
     }
     try:
         r = MethodRequest(**request.get("body"))
@@ -271,6 +428,7 @@ def method_handler(request, context, store):
 
     if not r.method:
         return {"code": INVALID_REQUEST, "error": "INVALID_REQUEST"}, INVALID_REQUEST
+    context["method"] = r.method
 
     if not check_auth(r):
         return None, FORBIDDEN
@@ -279,10 +437,33 @@ def method_handler(request, context, store):
     return response, code
 
 
+JSONSerializer = namedtuple("JSONSerializer", ["name", "loads", "dumps"])
+
+
+def get_json_serializer(backend="auto"):
+    """Returns loads and dumps of a JSON library, dumps gives bytes.
+
+    auto picks orjson or ujson if one is installed, else the stdlib json.
+    """
+    if backend == "auto":
+        backend = "orjson" if orjson else "ujson" if ujson else "json"
+    if backend == "orjson" and orjson:
+        # clients_interests responses are keyed by int client ids
+        return JSONSerializer(
+            "orjson", orjson.loads, lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        )
+    if backend == "ujson" and ujson:
+        return JSONSerializer("ujson", ujson.loads, lambda obj: ujson.dumps(obj).encode())
+    if backend == "json":
+        return JSONSerializer("json", json.loads, lambda obj: json.dumps(obj).encode())
+    raise ValueError("JSON library %s is not installed" % backend)
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
-    logging.debug("MainHTTPHandler")
     router = {"method": method_handler}
-    store = RedisAsStorage(host=os.getenv("REDIS_HOST", "localhost"))
+    # set up in __main__, the connection pool is sized to the number of threads
+    store = None
+    serializer = get_json_serializer()
 
     def get_request_id(self, headers):
         return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
@@ -293,13 +474,14 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         request = None
         try:
             data_string = self.rfile.read(int(self.headers["Content-Length"]))
-            request = json.loads(data_string)
+            request = self.serializer.loads(data_string)
         except:
             code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            # Bodies are formatted only if debug logging is on
+            logging.debug("%s: %s %s", self.path, data_string, context["request_id"])
             if path in self.router:
                 try:
                     response, code = self.router[path](
@@ -318,27 +500,171 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             r = {"response": response, "code": code}
         else:
             r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        # one short line per request, the context with the response only for
+        # debugging: formatting it costs as much as serializing the response
+        logging.info("%s %s %s %s", context["request_id"], self.path,
+                     context.get("method", "-"), code)
         context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode())
+        logging.debug("%s", context)
+        self.wfile.write(self.serializer.dumps(r))
         return
 
 
+class PoolHTTPServer(HTTPServer):
+    """HTTPServer handling requests in a fixed pool of threads.
+
+    At most `threads + queue_size` connections are accepted and not yet
+    answered, after that the accept loop waits and new clients stay in the
+    listen backlog instead of piling up in memory.
+    """
+
+    def __init__(self, server_address, handler_class, threads=THREADS, queue_size=QUEUE_SIZE):
+        # the default backlog of 5 drops connections of a burst of clients
+        self.request_queue_size = queue_size
+        super().__init__(server_address, handler_class)
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+        self.executor = None
+
+    def process_request(self, request, client_address):
+        # Created lazily, so that pre-forked workers don't inherit threads
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="api")
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def build_store(host="localhost", port=6379, timeout=STORE_TIMEOUT, retries=STORE_RETRIES,
+                max_connections=THREADS):
+    # local cache, then fast failures while Redis is down, then Redis itself
+    return CachedStorage(
+        FailFastStorage(
+            RedisAsStorage(
+                host=host,
+                port=port,
+                timeout=timeout,
+                retries=retries,
+                max_connections=max_connections,
+            )
+        )
+    )
+
+
+def serve(server):
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    store = server.RequestHandlerClass.store
+    if hasattr(store, "stats"):
+        logging.info("Store stats of process %s: %s" % (os.getpid(), store.stats()))
+    if hasattr(store, "close"):
+        store.close()
+
+
+def serve_prefork(server, workers):
+    """Forks workers accepting connections on the shared listening socket"""
+    # pids of the workers not reaped yet
+    pids = []
+    # a signal may come at any point after the first fork
+    try:
+        for _ in range(workers):
+            pids.append(fork_worker(server))
+        logging.info("Started %s workers: %s" % (workers, pids))
+        reap(pids)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        reap(pids)
+    server.server_close()
+
+
+def fork_worker(server):
+    """Forks a process serving requests, returns its pid"""
+    # Python drops the signals which come while a forked process is being set
+    # up, blocked ones wait in the kernel until the worker can stop on them
+    signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            serve(server)
+            code = 0
+        except KeyboardInterrupt:
+            code = 0
+        except Exception:
+            logging.exception("Worker %s failed" % os.getpid())
+        finally:
+            # never fall back into the parent's code
+            os._exit(code)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+    return pid
+
+
+def reap(pids):
+    """Waits for the workers to exit, removing each reaped pid from `pids`"""
+    for pid in list(pids):
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            # reaped just before an interrupt, before it was removed
+            pass
+        pids.remove(pid)
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=1,
+                  help="processes accepting connections, forked after binding the port")
+    op.add_option("-t", "--threads", action="store", type=int, default=THREADS,
+                  help="threads handling requests in every process")
+    op.add_option("--store-timeout", action="store", type=float, default=STORE_TIMEOUT,
+                  help="Redis socket timeout, seconds")
+    op.add_option("--store-retries", action="store", type=int, default=STORE_RETRIES)
+    op.add_option("--json", action="store", type="choice", choices=JSON_BACKENDS, default="auto",
+                  help="JSON library, auto picks orjson or ujson if installed")
+    op.add_option("--log-level", action="store", default="INFO",
+                  help="INFO logs a line per request, DEBUG also the bodies and responses")
     (opts, args) = op.parse_args()
     logging.basicConfig(
         filename=opts.log,
-        level=logging.INFO,
+        level=getattr(logging, opts.log_level.upper()),
         format="[%(asctime)s] %(levelname).1s %(message)s",
         datefmt="%Y.%m.%d %H:%M:%S",
     )
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    MainHTTPHandler.store = build_store(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        timeout=opts.store_timeout,
+        retries=opts.store_retries,
+        max_connections=opts.threads,
+    )
+    MainHTTPHandler.serializer = get_json_serializer(opts.json)
+    server = PoolHTTPServer(("localhost", opts.port), MainHTTPHandler, opts.threads)
     logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    # stop on `kill` as on Ctrl+C, forked workers inherit it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if opts.workers > 1:
+        serve_prefork(server, opts.workers)
+    else:
+        serve(server)
@@ -0,0 +1,317 @@
+"""Micro-benchmarks of the scoring API request handling.
+
+    python benchmark.py validate --requests 100000
+    python benchmark.py auth --requests 100000
+    python benchmark.py handle --requests 20000 --log-level INFO
+    python benchmark.py load --requests 20000 --concurrency 32 --client-ids 50
+
+`handle` runs MainHTTPHandler.do_POST on in-memory streams with every
+available JSON library and reports the CPU time per request, logs go to
+/dev/null.
+
+`load` starts fake_redis.py and the API server in this process, sends a
+mix of online_score and clients_interests requests from --concurrency
+client threads and reports the throughput, latency percentiles and the
+server time spent in validation, auth, store and serialization. Clients
+share the GIL with the server, so compare runs rather than absolute numbers.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from http.client import HTTPConnection
+from optparse import OptionParser
+from unittest.mock import patch
+
+import api
+from store import MemoryStorage
+
+FAKE_REDIS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_redis.py")
+STAGES = ("validation", "auth", "store", "serialization", "other")
+
+ONLINE_SCORE_ARGUMENTS = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "first_name": "Станислав",
+    "last_name": "Ступников",
+    "birthday": "01.01.1990",
+    "gender": 1,
+}
+CLIENTS_INTERESTS_ARGUMENTS = {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}
+
+
+def report(name, count, elapsed):
+    print("%-24s %10d requests %8.3f sec %12.0f requests/sec"
+          % (name, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def bench_validate(opts):
+    for request_class, arguments in ((api.OnlineScoreRequest, ONLINE_SCORE_ARGUMENTS),
+                                     (api.ClientsInterestsRequest, CLIENTS_INTERESTS_ARGUMENTS)):
+        started = time.perf_counter()
+        for _ in range(opts.requests):
+            request_class(**arguments).validate()
+        report(request_class.__name__, opts.requests, time.perf_counter() - started)
+
+
+def bench_auth(opts):
+    for login in ("h&f", api.ADMIN_LOGIN):
+        if login == api.ADMIN_LOGIN:
+            msg = time.strftime("%Y%m%d%H") + api.ADMIN_SALT
+        else:
+            msg = "horns&hoofs" + login + api.SALT
+        token = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+        request = api.MethodRequest(account="horns&hoofs", login=login, token=token)
+        started = time.perf_counter()
+        for _ in range(opts.requests):
+            api.check_auth(request)
+        report("check_auth %s" % login, opts.requests, time.perf_counter() - started)
+
+
+class BenchmarkHandler(api.MainHTTPHandler):
+    """do_POST without a socket: the request is read from and the response written to BytesIO"""
+
+    def __init__(self, body):
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+        self.headers = {"Content-Length": str(len(body))}
+        self.path = "/method/"
+        self.command = "POST"
+        self.request_version = "HTTP/1.1"
+        self.requestline = "POST /method/ HTTP/1.1"
+        self.client_address = ("127.0.0.1", 0)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_request(method, arguments):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+    msg = request["account"] + request["login"] + api.SALT
+    request["token"] = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+    return json.dumps(request).encode()
+
+
+def bench_handle(opts):
+    logging.basicConfig(filename=os.devnull, level=getattr(logging, opts.log_level.upper()))
+    BenchmarkHandler.store = MemoryStorage()
+    bodies = (("online_score", make_request("online_score", ONLINE_SCORE_ARGUMENTS)),
+              ("clients_interests", make_request("clients_interests", CLIENTS_INTERESTS_ARGUMENTS)))
+    for backend in api.JSON_BACKENDS[1:]:
+        try:
+            BenchmarkHandler.serializer = api.get_json_serializer(backend)
+        except ValueError:
+            print("%s is not installed" % backend)
+            continue
+        for method, body in bodies:
+            started = time.process_time()
+            for _ in range(opts.requests):
+                BenchmarkHandler(body).do_POST()
+            elapsed = time.process_time() - started
+            report("%s %s" % (backend, method), opts.requests, elapsed)
+
+
+def percentile(values, p):
+    """p-th percentile of sorted values, nearest rank"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def start_fake_redis(port, latency=0.0):
+    proc = subprocess.Popen([sys.executable, FAKE_REDIS, "--port", str(port),
+                             "--latency", str(latency)], stderr=subprocess.DEVNULL)
+    deadline = time.time() + 5
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            if time.time() > deadline:
+                proc.kill()
+                raise RuntimeError("Fake redis did not start on %s" % port)
+            time.sleep(0.05)
+
+
+class StageTimer:
+    """Adds the time spent in wrapped callables to the stages of the current request"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages = self.local.stages
+                stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - started
+        return timed
+
+    def handler(self, handler_class):
+        timer = self
+
+        class TimedHandler(handler_class):
+            def do_POST(self):
+                timer.local.stages = stages = {}
+                started = time.perf_counter()
+                super().do_POST()
+                total = time.perf_counter() - started
+                stages["other"] = total - sum(stages.values())
+                with timer.lock:
+                    timer.requests.append((total, stages))
+
+            def log_message(self, format, *args):
+                pass
+
+        return TimedHandler
+
+
+class TimedStore:
+    def __init__(self, store, timer):
+        for method in ("get", "get_many", "set", "set_many"):
+            setattr(self, method, timer.wrap("store", getattr(store, method)))
+
+
+def make_load_bodies(opts):
+    rnd = random.Random(opts.seed)
+    phones = ["7%010d" % rnd.randrange(10 ** 10) for _ in range(opts.users)]
+    bodies = []
+    for _ in range(opts.requests):
+        if rnd.random() < opts.score_share:
+            arguments = {"phone": rnd.choice(phones), "email": "stupnikov@otus.ru",
+                         "birthday": "01.01.1990", "gender": rnd.choice((0, 1, 2))}
+            bodies.append(make_request("online_score", arguments))
+        else:
+            client_ids = rnd.sample(range(opts.clients), min(opts.client_ids, opts.clients))
+            bodies.append(make_request("clients_interests", {"client_ids": client_ids}))
+    return bodies
+
+
+def bench_load(opts):
+    logging.basicConfig(filename=os.devnull, level=getattr(logging, opts.log_level.upper()))
+    fake = start_fake_redis(opts.redis_port, opts.redis_latency)
+    timer = StageTimer()
+    try:
+        store = api.build_store(port=opts.redis_port, max_connections=opts.threads)
+        rnd = random.Random(opts.seed)
+        interests = ("cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv")
+        for start in range(0, opts.clients, 1000):
+            store.set_many({"i:%s" % cid: json.dumps(rnd.sample(interests, 2))
+                            for cid in range(start, min(start + 1000, opts.clients))}, 60 * 60)
+
+        handler = timer.handler(api.MainHTTPHandler)
+        handler.store = TimedStore(store, timer)
+        serializer = api.MainHTTPHandler.serializer
+        handler.serializer = api.JSONSerializer(serializer.name,
+                                                timer.wrap("serialization", serializer.loads),
+                                                timer.wrap("serialization", serializer.dumps))
+        server = api.PoolHTTPServer(("localhost", 0), handler, opts.threads)
+        server_thread = threading.Thread(target=server.serve_forever)
+        with ExitStack() as patches:
+            patches.enter_context(patch.object(api, "check_auth",
+                                               timer.wrap("auth", api.check_auth)))
+            for request_class in (api.MethodRequest, api.OnlineScoreRequest,
+                                  api.ClientsInterestsRequest, api.OnlineScoreBatchRequest):
+                patches.enter_context(patch.object(
+                    request_class, "validate", timer.wrap("validation", request_class.validate)))
+            server_thread.start()
+            try:
+                latencies, errors, elapsed = run_load(server.server_address, make_load_bodies(opts),
+                                                      opts.concurrency)
+            finally:
+                server.shutdown()
+                server.server_close()
+                server_thread.join()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    print("%d requests, %d errors, %.2f sec, %.0f requests/sec, %s JSON"
+          % (len(latencies), errors, elapsed, len(latencies) / elapsed, serializer.name))
+    latencies.sort()
+    print("latency, ms:  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f"
+          % tuple(1000 * value for value in (percentile(latencies, 50), percentile(latencies, 90),
+                                             percentile(latencies, 99), latencies[-1])))
+    total = sum(request_total for request_total, _ in timer.requests)
+    print("%-14s %9s %9s %9s %7s" % ("server stage", "mean ms", "p50 ms", "p99 ms", "share"))
+    for stage in STAGES:
+        values = sorted(stages.get(stage, 0.0) for _, stages in timer.requests)
+        print("%-14s %9.3f %9.3f %9.3f %6.1f%%"
+              % (stage, 1000 * sum(values) / len(values), 1000 * percentile(values, 50),
+                 1000 * percentile(values, 99), 100 * sum(values) / total))
+    print("cache: %s" % store.stats()["cache"])
+
+
+def run_load(address, bodies, concurrency):
+    """Posts the bodies from `concurrency` threads, returns (latencies, errors, elapsed)"""
+    latencies = []
+    errors = []
+
+    def post(body):
+        started = time.perf_counter()
+        connection = HTTPConnection(*address, timeout=10)
+        try:
+            connection.request("POST", "/method/", body)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == api.OK
+        except OSError:
+            ok = False
+        finally:
+            connection.close()
+        latencies.append(time.perf_counter() - started)
+        if not ok:
+            errors.append(body)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(post, bodies))
+    return latencies, len(errors), time.perf_counter() - started
+
+
+BENCHMARKS = {
+    "validate": bench_validate,
+    "auth": bench_auth,
+    "handle": bench_handle,
+    "load": bench_load,
+}
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] " + "|".join(sorted(BENCHMARKS)))
+    op.add_option("--requests", action="store", type=int, default=100000)
+    op.add_option("--log-level", action="store", default="INFO", help="handle, load: logging level")
+    op.add_option("--seed", action="store", type=int, default=42)
+    op.add_option("--concurrency", action="store", type=int, default=16,
+                  help="load: client threads")
+    op.add_option("--threads", action="store", type=int, default=api.THREADS,
+                  help="load: server threads")
+    op.add_option("--score-share", action="store", type=float, default=0.5,
+                  help="load: share of online_score requests, the rest are clients_interests")
+    op.add_option("--users", action="store", type=int, default=1000,
+                  help="load: distinct people scored")
+    op.add_option("--clients", action="store", type=int, default=10000,
+                  help="load: clients with interests in Redis")
+    op.add_option("--client-ids", action="store", type=int, default=10,
+                  help="load: client ids per clients_interests request")
+    op.add_option("--redis-port", action="store", type=int, default=6380)
+    op.add_option("--redis-latency", action="store", type=float, default=0.0,
+                  help="load: fake redis reply delay, seconds")
+    (opts, args) = op.parse_args()
+    if not args or args[0] not in BENCHMARKS:
+        op.print_usage()
+        sys.exit(2)
+    BENCHMARKS[args[0]](opts)
@@ -0,0 +1,157 @@
+"""In-memory stand-in for Redis, speaks RESP.
+
+Supports PING, GET, SET (with EX/PX), MGET, DEL, EXISTS, FLUSHDB, SELECT
+and CLIENT, which is enough for RedisAsStorage and pipelines of these
+commands. Every reply can be delayed by --latency seconds to see how the
+API behaves with a remote Redis.
+
+    python fake_redis.py --port 6380 --latency 0.0005
+"""
+import asyncio
+import logging
+import sys
+import time
+from optparse import OptionParser
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_command(buffer, start):
+    """Returns (args, end) of the command at `start`, args is None if it is incomplete"""
+    end = buffer.find(b"\r\n", start)
+    if end < 0:
+        return None, start
+    if buffer[start:start + 1] != b"*":
+        # inline command, e.g. typed in telnet
+        return buffer[start:end].split(), end + 2
+    count = int(buffer[start + 1:end])
+    pos = end + 2
+    args = []
+    for _ in range(count):
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            return None, start
+        if buffer[pos:pos + 1] != b"$":
+            raise ProtocolError("expected '$', got '%s'" % buffer[pos:pos + 1].decode(errors="replace"))
+        size = int(buffer[pos + 1:end])
+        pos = end + 2
+        if len(buffer) < pos + size + 2:
+            return None, start
+        args.append(buffer[pos:pos + size])
+        pos += size + 2
+    return args, pos
+
+
+def bulk(value):
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+OK = b"+OK\r\n"
+
+
+class FakeRedisProtocol(asyncio.Protocol):
+    def __init__(self, data, latency=0.0):
+        self.data = data
+        self.latency = latency
+        self.buffer = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        replies = []
+        start = 0
+        while True:
+            try:
+                args, start = parse_command(buffer, start)
+            except (ProtocolError, ValueError) as e:
+                self.write(b"-ERR Protocol error: %s\r\n" % str(e).encode())
+                self.transport.close()
+                return
+            if args is None:
+                break
+            if args:
+                replies.append(self.handle(args))
+        self.buffer = buffer[start:]
+        if not replies:
+            return
+        data = b"".join(replies)
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self.write, data)
+        else:
+            self.write(data)
+
+    def write(self, data):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def handle(self, args):
+        command = args[0].upper()
+        if command == b"GET" and len(args) == 2:
+            return bulk(self.get(args[1]))
+        if command == b"MGET" and len(args) > 1:
+            return b"*%d\r\n" % (len(args) - 1) + b"".join(bulk(self.get(key)) for key in args[1:])
+        if command == b"SET" and len(args) >= 3:
+            expires = None
+            options = [arg.upper() for arg in args[3:]]
+            try:
+                if b"EX" in options:
+                    expires = time.monotonic() + int(args[3 + options.index(b"EX") + 1])
+                elif b"PX" in options:
+                    expires = time.monotonic() + int(args[3 + options.index(b"PX") + 1]) / 1000.0
+            except (IndexError, ValueError):
+                return b"-ERR syntax error\r\n"
+            self.data[args[1]] = (args[2], expires)
+            return OK
+        if command == b"DEL" and len(args) > 1:
+            return b":%d\r\n" % sum(self.data.pop(key, None) is not None for key in args[1:])
+        if command == b"EXISTS" and len(args) > 1:
+            return b":%d\r\n" % sum(self.get(key) is not None for key in args[1:])
+        if command == b"PING":
+            return bulk(args[1]) if len(args) > 1 else b"+PONG\r\n"
+        if command == b"FLUSHDB":
+            self.data.clear()
+            return OK
+        if command in (b"SELECT", b"CLIENT"):
+            return OK
+        return b"-ERR unknown command '%s'\r\n" % args[0]
+
+
+async def serve(host, port, latency=0.0):
+    loop = asyncio.get_running_loop()
+    data = {}
+    server = await loop.create_server(lambda: FakeRedisProtocol(data, latency), host, port)
+    logging.info("Fake redis listening on %s:%s" % (host, port))
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("--port", action="store", type=int, default=6380)
+    op.add_option("--latency", action="store", type=float, default=0.0,
+                  help="seconds to delay every reply")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname).1s %(message)s",
+                        datefmt="%Y.%m.%d %H:%M:%S")
+    try:
+        asyncio.run(serve(opts.host, opts.port, opts.latency))
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -1,8 +1,13 @@
 import hashlib
 import json
 
+from redis.exceptions import ConnectionError, TimeoutError
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+
+SCORE_TTL = 60 * 60
+
+
+def get_score_key(phone, birthday=None, first_name=None, last_name=None):
     # (phone + email) or (first_name  + last_name ) or (birthday + gender)
     key_parts = [
         first_name or '',
@@ -10,12 +15,11 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         str(phone) or '',
         birthday or '',
     ]
-    key = 'uid:' + hashlib.md5(''.join(key_parts).encode()).hexdigest()
-    
-    score = store.get(key) or 0
-    if score is not None:
-        return score
-    
+    return 'uid:' + hashlib.md5(''.join(key_parts).encode()).hexdigest()
+
+
+def compute_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -24,12 +28,76 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    
+    return score
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+
+    # The cache is optional: if the store is down, the score is computed
+    # and the write is skipped
+    try:
+        score = store.get(key)
+    except (ConnectionError, TimeoutError):
+        score, cache_available = None, False
+    else:
+        cache_available = True
+    if score is not None:
+        return float(score)
+
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
+
     # Cache for 60 minutes
-    store.set(key, score, 60 * 60)
+    if cache_available:
+        try:
+            store.set(key, score, SCORE_TTL)
+        except (ConnectionError, TimeoutError):
+            pass
     return score
 
 
+def get_scores_many(store, people):
+    """get_score for a list of dicts of its arguments, in the same order.
+
+    Cached scores are fetched with one get_many and the computed ones
+    are cached with one set_many.
+    """
+    if not people:
+        return []
+    keys = [
+        get_score_key(p['phone'], p['birthday'], p['first_name'], p['last_name'])
+        for p in people
+    ]
+    try:
+        cached = store.get_many(keys)
+    except (ConnectionError, TimeoutError):
+        cached, cache_available = [None] * len(keys), False
+    else:
+        cache_available = True
+
+    scores = []
+    computed = {}
+    for key, person, score in zip(keys, people, cached):
+        if score is None:
+            score = computed[key] = compute_score(**person)
+        else:
+            score = float(score)
+        scores.append(score)
+
+    if computed and cache_available:
+        try:
+            store.set_many(computed, SCORE_TTL)
+        except (ConnectionError, TimeoutError):
+            pass
+    return scores
+
+
 def get_interests(store, cid):
     r = store.get('i:{}'.format(cid))
     return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids):
+    keys = ['i:{}'.format(cid) for cid in cids]
+    values = store.get_many(keys)
+    return {cid: json.loads(r) if r else [] for cid, r in zip(cids, values)}
@@ -1,13 +1,76 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from redis.backoff import ExponentialBackoff
 from redis.retry import Retry
 from redis.client import Redis
+from redis.connection import BlockingConnectionPool
 from redis.exceptions import BusyLoadingError, ConnectionError, TimeoutError
 
 
 DEFAULT_TTL = 100
+# in-process cache: entries kept and seconds a value read from the storage is trusted
+CACHE_SIZE = 10000
+CACHE_TTL = 60
+# connections shared by the handler threads of a process, match it to their number
+POOL_SIZE = 16
+HEALTH_CHECK_INTERVAL = 30
+# failed calls in a row before the storage is skipped and seconds to skip it for
+BREAKER_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 10
+
+
+class StorageUnavailable(ConnectionError):
+    """Raised without touching the network while the circuit breaker is open"""
+
+
+class OperationMetrics:
+    """Calls, errors and time spent per storage operation, thread safe"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    @contextmanager
+    def measure(self, operation):
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                stats = self.operations.get(operation)
+                if stats is None:
+                    stats = self.operations[operation] = {
+                        "calls": 0, "errors": 0, "time": 0.0, "max_time": 0.0}
+                stats["calls"] += 1
+                stats["errors"] += failed
+                stats["time"] += elapsed
+                stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                operation: dict(stats, avg_time=stats["time"] / stats["calls"])
+                for operation, stats in self.operations.items()
+            }
 
 
 class RedisAsStorage:
+    """Redis client with a bounded connection pool shared by all threads.
+
+    When all `max_connections` are busy a call waits up to `timeout` for a
+    free one. Redis errors (ConnectionError, TimeoutError, ...) are raised
+    as they are after the retries, other exceptions are not touched.
+    """
+
     def __init__(
         self,
         host: str = "localhost",
@@ -16,18 +79,27 @@ class RedisAsStorage:
         timeout: int = 5,
         retries: int = 5,
         connect_now: bool = True,
+        max_connections: int = POOL_SIZE,
+        health_check_interval: int = HEALTH_CHECK_INTERVAL,
+        socket_keepalive: bool = True,
     ) -> None:
         self.host = host
         self.port = port
         self.db = db
         self.timeout = timeout
         self.retries = retries
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.socket_keepalive = socket_keepalive
+        self.metrics = OperationMetrics()
 
         if connect_now is True:
             self.connect()
 
     def connect(self):
-        self.con = Redis(
+        self.pool = BlockingConnectionPool(
+            max_connections=self.max_connections,
+            timeout=self.timeout,
             host=self.host,
             port=self.port,
             db=self.db,
@@ -35,17 +107,221 @@ class RedisAsStorage:
             retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError],
             socket_connect_timeout=self.timeout,
             socket_timeout=self.timeout,
+            socket_keepalive=self.socket_keepalive,
+            # idle connections are PINGed before use, dropped ones are reopened
+            health_check_interval=self.health_check_interval,
         )
+        self.con = Redis(connection_pool=self.pool)
 
     def get(self, key):
-        try:
+        with self.metrics.measure("get"):
             value = self.con.get(key)
-            return value.decode() if value else value
-        except:
-            raise ConnectionError
+        return value.decode() if value else value
+
+    def get_many(self, keys):
+        """Fetches all keys with a single MGET, missing ones are None"""
+        if not keys:
+            return []
+        with self.metrics.measure("get_many"):
+            values = self.con.mget(keys)
+        return [value.decode() if value else value for value in values]
 
     def set(self, key, value, ttl=DEFAULT_TTL):
-        try:
+        with self.metrics.measure("set"):
             return self.con.set(key, value, ex=ttl)
-        except:
-            raise ConnectionError
+
+    def set_many(self, mapping, ttl=DEFAULT_TTL):
+        """Writes all keys with one pipeline round trip"""
+        if not mapping:
+            return True
+        with self.metrics.measure("set_many"):
+            pipeline = self.con.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipeline.set(key, value, ex=ttl)
+            return all(pipeline.execute())
+
+    def stats(self):
+        return self.metrics.snapshot()
+
+    def close(self):
+        """Closes the pooled connections, for the process shutdown"""
+        self.pool.disconnect()
+
+
+class MemoryStorage:
+    """Dict based storage with expiring keys, for tests and local runs"""
+
+    def __init__(self) -> None:
+        self.data = {}
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        # Redis keeps strings only
+        self.data[key] = (str(value), time.monotonic() + ttl)
+        return True
+
+    def set_many(self, mapping, ttl=DEFAULT_TTL):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+        return True
+
+
+class CachedStorage:
+    """Cache-aside in-process LRU in front of another storage.
+
+    Values written with set stay in the cache for their ttl, like in the
+    storage. Values read from the storage are kept for `ttl` seconds at
+    most, so that writes of other processes show up. get_many always goes
+    to the storage.
+    """
+
+    def __init__(self, store, maxsize: int = CACHE_SIZE, ttl: int = CACHE_TTL) -> None:
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+        value = self.store.get(key)
+        if value is not None:
+            self.remember(key, value, self.ttl)
+        return value
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def stats(self):
+        stats = {"cache": {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}}
+        if hasattr(self.store, "stats"):
+            stats.update(self.store.stats())
+        return stats
+
+    def close(self):
+        if hasattr(self.store, "close"):
+            self.store.close()
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        result = self.store.set(key, value, ttl)
+        self.remember(key, str(value), ttl)
+        return result
+
+    def set_many(self, mapping, ttl=DEFAULT_TTL):
+        result = self.store.set_many(mapping, ttl)
+        for key, value in mapping.items():
+            self.remember(key, str(value), ttl)
+        return result
+
+    def remember(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class Outage:
+    """Connection failures in a row and when the storage may be tried again"""
+
+    def __init__(self) -> None:
+        self.failures = 0
+        # time.monotonic() before which calls are not sent, None while healthy
+        self.retry_at = None
+
+
+class FailFastStorage:
+    """Skips the storage while it is down.
+
+    After `threshold` calls in a row fail with a connection error or a
+    timeout, calls raise StorageUnavailable at once for `reset_timeout`
+    seconds. Then the next call goes to the storage and the others keep
+    failing fast for one more period: if it succeeds the storage is used
+    again, otherwise it stays skipped.
+    """
+
+    def __init__(
+        self,
+        store,
+        threshold: int = BREAKER_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+    ) -> None:
+        self.store = store
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.outage = Outage()
+
+    def get(self, key):
+        return self.call(self.store.get, key)
+
+    def get_many(self, keys):
+        return self.call(self.store.get_many, keys)
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        return self.call(self.store.set, key, value, ttl)
+
+    def set_many(self, mapping, ttl=DEFAULT_TTL):
+        return self.call(self.store.set_many, mapping, ttl)
+
+    def stats(self):
+        stats = self.store.stats() if hasattr(self.store, "stats") else {}
+        stats["breaker"] = {
+            "open": self.outage.retry_at is not None, "failures": self.outage.failures}
+        return stats
+
+    def close(self):
+        if hasattr(self.store, "close"):
+            self.store.close()
+
+    def call(self, method, *args):
+        outage = self.outage
+        with self.lock:
+            if outage.retry_at is not None:
+                now = time.monotonic()
+                if now < outage.retry_at:
+                    raise StorageUnavailable("Storage is unavailable, circuit breaker is open")
+                # this call tries the storage, the next ones wait for its result
+                outage.retry_at = now + self.reset_timeout
+        try:
+            result = method(*args)
+        except (ConnectionError, TimeoutError):
+            with self.lock:
+                outage.failures += 1
+                if outage.retry_at is None and outage.failures >= self.threshold:
+                    outage.retry_at = time.monotonic() + self.reset_timeout
+                    logging.error(
+                        "Storage is down, failing calls fast for %s sec" % self.reset_timeout
+                    )
+            raise
+        # other errors are about the command or the value, not the storage health
+        if outage.failures:
+            with self.lock:
+                if outage.retry_at is not None:
+                    logging.info("Storage is back, closing the circuit breaker")
+                outage.failures = 0
+                outage.retry_at = None
+        return result
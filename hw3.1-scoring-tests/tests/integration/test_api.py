@@ -3,6 +3,7 @@ import datetime
 import unittest
 
 import api
+from store import MemoryStorage
 from ..utils import cases
 
 
@@ -10,7 +11,7 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.settings = {}
+        self.settings = MemoryStorage()
 
     def get_response(self, request):
         return api.method_handler(
@@ -218,6 +219,69 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(len(arguments["client_ids"]), len(response))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    @cases(
+        [
+            {},
+            {"items": []},
+            {"items": {"phone": "79175002040"}},
+            {"items": ["79175002040"]},
+            {"items": [{"phone": "79175002040", "email": "stupnikov@otus.ru"}] * 1001},
+        ]
+    )
+    def test_invalid_score_batch_request(self, arguments):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score_batch",
+            "arguments": arguments,
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+        self.assertTrue(len(response))
+
+    def test_ok_score_batch_request(self):
+        items = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": "79175002040"},
+            {"first_name": "a", "last_name": "b"},
+            {"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+        ]
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score_batch",
+            "arguments": {"items": items},
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        scores = response["scores"]
+        self.assertEqual(len(scores), len(items))
+        self.assertEqual(scores[1]["code"], api.INVALID_REQUEST)
+        self.assertTrue(scores[1]["error"])
+        self.assertEqual([scores[i]["score"] for i in (0, 2, 3, 4)], [3.0, 0.5, 2.0, 3.0])
+        self.assertEqual(self.context["nitems"], len(items))
+        for i in (0, 2, 3):
+            _, code = self.get_response(
+                dict(request, method="online_score", arguments=items[i])
+            )
+            self.assertEqual(api.OK, code)
+        self.assertEqual(len(self.settings.data), 3)
+
+    def test_ok_score_batch_admin_request(self):
+        request = {
+            "account": "horns&hoofs",
+            "login": "admin",
+            "method": "online_score_batch",
+            "arguments": {"items": [{}, {"phone": "79175002040"}]},
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"scores": [{"score": 42}, {"score": 42}]})
+
 
 if __name__ == "__main__":
     unittest.main()
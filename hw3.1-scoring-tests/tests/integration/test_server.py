@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from http.client import HTTPConnection
+from unittest.mock import patch
+
+import api
+from store import MemoryStorage
+
+API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "api.py")
+
+
+class BlockingStorage(MemoryStorage):
+    """Blocks reads of `blocked_key` until `released` is set"""
+
+    def __init__(self, blocked_key):
+        super().__init__()
+        self.blocked_key = blocked_key
+        self.released = threading.Event()
+
+    def get(self, key):
+        if key == self.blocked_key:
+            self.released.wait(5)
+        return super().get(key)
+
+
+class TestPoolHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.store = BlockingStorage("i:1")
+        handler = type("Handler", (api.MainHTTPHandler,), {"store": self.store})
+        handler.log_message = lambda *args: None
+        self.server = api.PoolHTTPServer(("localhost", 0), handler, threads=2, queue_size=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.store.released.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def post(self, arguments, results=None):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": arguments}
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+        connection = HTTPConnection(*self.server.server_address, timeout=5)
+        connection.request("POST", "/method/", json.dumps(request))
+        response = json.loads(connection.getresponse().read())
+        connection.close()
+        if results is not None:
+            results.append(response)
+        return response
+
+    def test_slow_request_does_not_block_others(self):
+        results = []
+        slow = threading.Thread(target=self.post, args=({"client_ids": [1]}, results))
+        slow.start()
+        response = self.post({"client_ids": [2, 3]})
+        self.assertEqual(response, {"code": api.OK, "response": {"2": [], "3": []}})
+        self.assertEqual(results, [])
+        self.store.released.set()
+        slow.join()
+        self.assertEqual(results, [{"code": api.OK, "response": {"1": []}}])
+
+    def test_request_logged(self):
+        with self.assertLogs(level="DEBUG") as logs:
+            self.post({"client_ids": [2]})
+        info = [line for line in logs.output if line.startswith("INFO:")]
+        self.assertEqual(len(info), 1)
+        self.assertRegex(info[0], r"^INFO:root:[0-9a-f]{32} /method/ clients_interests 200$")
+        # the body and the response are logged only at DEBUG
+        debug = "\n".join(line for line in logs.output if line.startswith("DEBUG:"))
+        self.assertIn("client_ids", debug)
+        self.assertIn("'response': {2: []}", debug)
+
+
+class TestForkWorker(unittest.TestCase):
+    def test_stopped_right_after_fork(self):
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+        with patch.object(api, "serve", lambda server: time.sleep(5)):
+            pid = api.fork_worker(None)
+        # comes while the worker is being set up, must not be lost
+        os.kill(pid, signal.SIGTERM)
+        started = time.monotonic()
+        _, status = os.waitpid(pid, 0)
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, API, "-p", str(port), "-w", "2"],
+            stderr=subprocess.PIPE, text=True, start_new_session=True)
+        self.addCleanup(self.process.stderr.close)
+        line = self.process.stderr.readline()
+        while line and "Started" not in line:
+            line = self.process.stderr.readline()
+        self.pids = [int(pid) for pid in re.findall(r"\d+", line.split("workers:")[1])]
+
+    def tearDown(self):
+        # the workers share the session of the server, even if it has exited
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def assertStopped(self):
+        stderr = self.process.communicate(timeout=10)[1]
+        self.assertEqual(self.process.returncode, 0, stderr)
+        for pid in self.pids:
+            self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+    def test_stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.assertStopped()
+
+    def test_stop_after_worker_died(self):
+        os.kill(self.pids[0], signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        # the pid is gone once the server has reaped the worker
+        while time.monotonic() < deadline:
+            try:
+                os.kill(self.pids[0], 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.01)
+        os.killpg(self.process.pid, signal.SIGTERM)
+        self.assertStopped()
@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import MagicMock
 
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
 from store import RedisAsStorage
 
 
@@ -10,6 +13,9 @@ class TestStore(unittest.TestCase):
         self.key = "key"
         self.value = "value"
 
+    def tearDown(self):
+        self.store.close()
+
     def test_store_connected(self):
         self.assertTrue(self.store.set(self.key, self.value))
         self.assertEqual(self.store.get(self.key), self.value)
@@ -17,3 +23,30 @@ class TestStore(unittest.TestCase):
     def test_store_disconnected(self):
         self.store.get = MagicMock(side_effect=ConnectionError())
         self.assertRaises(ConnectionError, self.store.get, self.key)
+
+    def test_store_get_many_connected(self):
+        self.assertTrue(self.store.set(self.key, self.value))
+        self.assertEqual(self.store.get_many([self.key, "missing-key"]), [self.value, None])
+
+    def test_store_set_many_connected(self):
+        self.assertTrue(self.store.set_many({self.key: self.value, "other-key": 1}))
+        self.assertEqual(self.store.get_many([self.key, "other-key"]), [self.value, "1"])
+
+    def test_store_get_many_disconnected(self):
+        self.store.con.mget = MagicMock(side_effect=RedisTimeoutError())
+        self.assertRaises(RedisTimeoutError, self.store.get_many, [self.key])
+        self.assertEqual(self.store.metrics.snapshot()["get_many"]["errors"], 1)
+
+    def test_store_unreachable(self):
+        store = RedisAsStorage(port=1, timeout=0.1, retries=1)
+        self.addCleanup(store.close)
+        self.assertRaises(RedisConnectionError, store.get, self.key)
+        self.assertRaises(RedisConnectionError, store.set, self.key, self.value)
+        stats = store.metrics.snapshot()
+        self.assertEqual((stats["get"]["calls"], stats["get"]["errors"]), (1, 1))
+
+    def test_store_pool(self):
+        self.assertEqual(self.store.pool.max_connections, 16)
+        kwargs = self.store.pool.connection_kwargs
+        self.assertTrue(kwargs["socket_keepalive"])
+        self.assertEqual(kwargs["health_check_interval"], 30)
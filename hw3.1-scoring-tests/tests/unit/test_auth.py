@@ -0,0 +1,46 @@
+import datetime
+import hashlib
+import unittest
+from unittest.mock import patch
+
+import api
+from ..utils import cases
+
+
+def make_request(login, token, account="horns&hoofs"):
+    return api.MethodRequest(account=account, login=login, token=token, method="online_score")
+
+
+def admin_token(hour):
+    msg = hour.strftime("%Y%m%d%H") + api.ADMIN_SALT
+    return hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+
+
+class TestCheckAuth(unittest.TestCase):
+    def setUp(self):
+        api.get_user_digest.cache_clear()
+        api.admin_token = (0.0, None)
+        msg = "horns&hoofs" + "h&f" + api.SALT
+        self.token = hashlib.sha512(msg.encode("UTF-8")).hexdigest()
+
+    def test_user_memoized(self):
+        for _ in range(3):
+            self.assertTrue(api.check_auth(make_request("h&f", self.token)))
+        self.assertEqual(api.get_user_digest.cache_info().hits, 2)
+
+    @cases(["", "bad token", None])
+    def test_user_bad_token(self, token):
+        self.assertTrue(api.check_auth(make_request("h&f", self.token)))
+        self.assertFalse(api.check_auth(make_request("h&f", token)))
+        self.assertFalse(api.check_auth(make_request("h&f", self.token, account="other")))
+
+    def test_admin_rolls_over(self):
+        hour = datetime.datetime.now().replace(minute=59, second=59, microsecond=0)
+        next_hour = hour + datetime.timedelta(seconds=1)
+        with patch("api.time.time", return_value=hour.timestamp()):
+            self.assertTrue(api.check_auth(make_request("admin", admin_token(hour))))
+            self.assertFalse(api.check_auth(make_request("admin", admin_token(next_hour))))
+        with patch("api.time.time", return_value=next_hour.timestamp()):
+            self.assertTrue(api.check_auth(make_request("admin", admin_token(next_hour))))
+            self.assertFalse(api.check_auth(make_request("admin", admin_token(hour))))
+            self.assertFalse(api.check_auth(make_request("admin", self.token)))
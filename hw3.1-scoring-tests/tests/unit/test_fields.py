@@ -85,6 +85,24 @@ class TestDateField(unittest.TestCase):
     def test_invalid_format(self, value):
         self.assertRaises(ValueError, self.field.validate, value)
 
+    @cases([
+        ('01.01.2019', datetime(2019, 1, 1).date()),
+        ('1.1.2019', datetime(2019, 1, 1).date()),
+        ('31.1.0999', datetime(999, 1, 31).date()),
+        ('29.02.2020', datetime(2020, 2, 29).date()),
+    ])
+    def test_parse(self, value, date):
+        self.assertEqual(self.field.parse(value), date)
+        self.assertEqual(datetime.strptime(value, '%d.%m.%Y').date(), date)
+
+    @cases([
+        ' 1.01.2019', '1. 1.2019', '01.01.2019 ', '01.01.19', '01.01.02019', '001.01.2019',
+        '00.01.2019', '29.02.2019', '+1.01.2019', '\u0661.01.2019',
+    ])
+    def test_parse_invalid(self, value):
+        # stricter than strptime, which skips whitespace before the numbers
+        self.assertRaises(ValueError, self.field.parse, value)
+
 
 class TestBirthDayField(unittest.TestCase):
     def setUp(self):
@@ -124,5 +142,46 @@ class TestGenderField(unittest.TestCase):
         self.assertRaises(ValueError, self.field.validate, value)
 
 
+class TestRequest(unittest.TestCase):
+    class SampleRequest(api.Request):
+        login = api.CharField(required=True, nullable=True)
+        birthday = api.BirthDayField(required=False, nullable=True)
+
+    def test_fields(self):
+        self.assertEqual(list(self.SampleRequest._fields), ['login', 'birthday'])
+        self.assertEqual(self.SampleRequest.__slots__, ('login', 'birthday'))
+        request = self.SampleRequest(login='h&f', unknown=1)
+        self.assertEqual((request.login, request.birthday), ('h&f', None))
+        self.assertRaises(AttributeError, setattr, request, 'unknown', 1)
+
+    @cases([{'login': 'h&f'}, {'login': '', 'birthday': '01.01.2000'}])
+    def test_ok(self, arguments):
+        self.SampleRequest(**arguments).validate()
+
+    @cases([
+        ({}, ValueError),
+        ({'login': 1}, TypeError),
+        ({'login': 'h&f', 'birthday': '01.01.1910'}, ValueError),
+        ({'login': 'h&f', 'birthday': 1}, TypeError),
+    ])
+    def test_invalid(self, arguments, error):
+        self.assertRaises(error, self.SampleRequest(**arguments).validate)
+
+    def test_inherited_fields(self):
+        class SignedRequest(self.SampleRequest):
+            birthday = api.BirthDayField(required=True, nullable=False)
+            token = api.CharField(required=True, nullable=False)
+
+        self.assertEqual(list(SignedRequest._fields), ['login', 'birthday', 'token'])
+        self.assertEqual(SignedRequest.__slots__, ('token',))
+        request = SignedRequest(login='h&f', birthday='01.01.2000', token='t')
+        self.assertEqual((request.login, request.birthday, request.token),
+                         ('h&f', '01.01.2000', 't'))
+        request.validate()
+        self.assertRaises(AttributeError, setattr, request, 'unknown', 1)
+        self.assertRaises(ValueError, SignedRequest(login='h&f', token='t').validate)
+        self.assertRaises(ValueError, SignedRequest(birthday='01.01.2000', token='t').validate)
+
+
 if __name__ == '__main__':
     unittest.main()
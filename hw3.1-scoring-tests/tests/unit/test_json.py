@@ -0,0 +1,23 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import api
+from ..utils import cases
+
+
+class TestJSONSerializer(unittest.TestCase):
+    @cases(["auto", "json"] + [backend for backend in ("orjson", "ujson") if getattr(api, backend)])
+    def test_round_trip(self, backend):
+        serializer = api.get_json_serializer(backend)
+        response = {"response": {1: ["cars", "pets"], 2: []}, "code": api.OK}
+        data = serializer.dumps(response)
+        self.assertIsInstance(data, bytes)
+        expected = {"response": {"1": ["cars", "pets"], "2": []}, "code": api.OK}
+        self.assertEqual(json.loads(data), expected)
+        self.assertEqual(serializer.loads(data), expected)
+
+    def test_fallback(self):
+        with patch("api.orjson", None), patch("api.ujson", None):
+            self.assertEqual(api.get_json_serializer().name, "json")
+            self.assertRaises(ValueError, api.get_json_serializer, "orjson")
@@ -0,0 +1,98 @@
+import json
+import unittest
+from unittest.mock import MagicMock
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+import scoring
+from store import MemoryStorage, StorageUnavailable
+from ..utils import cases
+
+
+class TestGetInterestsMany(unittest.TestCase):
+    def setUp(self):
+        self.interests = {1: ["books", "cars"], 3: ["travel"]}
+        self.store = MemoryStorage()
+        self.store.set_many(
+            {"i:%s" % cid: json.dumps(value) for cid, value in self.interests.items()})
+
+    @cases([[1], [1, 2, 3], [3, 3, 0]])
+    def test_memory_store(self, cids):
+        interests = scoring.get_interests_many(self.store, cids)
+        self.assertEqual(sorted(interests), sorted(set(cids)))
+        for cid in cids:
+            self.assertEqual(interests[cid], self.interests.get(cid, []))
+            self.assertEqual(interests[cid], scoring.get_interests(self.store, cid))
+
+    def test_bulk_store(self):
+        store = MagicMock(wraps=self.store)
+        interests = scoring.get_interests_many(store, [1, 2, 3])
+        self.assertEqual(interests, {1: ["books", "cars"], 2: [], 3: ["travel"]})
+        store.get_many.assert_called_once_with(["i:1", "i:2", "i:3"])
+        store.get.assert_not_called()
+
+
+class TestGetScore(unittest.TestCase):
+    @cases(
+        [
+            ({"phone": "79175002040", "email": "stupnikov@otus.ru"}, 3.0),
+            ({"phone": None, "email": None, "first_name": "a", "last_name": "b"}, 0.5),
+            ({"phone": None, "email": None, "birthday": "01.01.2000", "gender": 1}, 1.5),
+        ]
+    )
+    def test_score_cached(self, arguments, expected):
+        self.store = MemoryStorage()
+        self.assertEqual(scoring.get_score(self.store, **arguments), expected)
+        self.assertEqual(len(self.store.data), 1)
+        key = next(iter(self.store.data))
+        self.store.set(key, 42)
+        self.assertEqual(scoring.get_score(self.store, **arguments), 42)
+
+    @cases([RedisConnectionError(), RedisTimeoutError(), StorageUnavailable()])
+    def test_store_down(self, error):
+        store = MagicMock()
+        store.get.side_effect = error
+        score = scoring.get_score(store, "79175002040", "stupnikov@otus.ru")
+        self.assertEqual(score, 3.0)
+        store.set.assert_not_called()
+
+    def test_cache_write_fails(self):
+        store = MagicMock()
+        store.get.return_value = None
+        store.set.side_effect = RedisTimeoutError()
+        self.assertEqual(scoring.get_score(store, "79175002040", "stupnikov@otus.ru"), 3.0)
+
+
+class TestGetScoresMany(unittest.TestCase):
+    def setUp(self):
+        self.people = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru", "birthday": None,
+             "gender": None, "first_name": None, "last_name": None},
+            {"phone": None, "email": None, "birthday": None,
+             "gender": None, "first_name": "a", "last_name": "b"},
+        ]
+
+    def test_same_as_get_score(self):
+        store = MemoryStorage()
+        self.assertEqual(scoring.get_scores_many(store, self.people), [3.0, 0.5])
+        for person in self.people:
+            self.assertEqual(scoring.get_score(MemoryStorage(), **person),
+                             scoring.get_score(store, **person))
+
+    def test_one_round_trip(self):
+        store = MagicMock()
+        store.get_many.return_value = ["42", None]
+        self.assertEqual(scoring.get_scores_many(store, self.people), [42.0, 0.5])
+        store.get_many.assert_called_once()
+        store.set_many.assert_called_once()
+        computed, ttl = store.set_many.call_args[0]
+        self.assertEqual(list(computed.values()), [0.5])
+        store.get.assert_not_called()
+        store.set.assert_not_called()
+
+    def test_store_down(self):
+        store = MagicMock()
+        store.get_many.side_effect = StorageUnavailable()
+        self.assertEqual(scoring.get_scores_many(store, self.people), [3.0, 0.5])
+        store.set_many.assert_not_called()
@@ -0,0 +1,166 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from scoring import get_score
+from store import CachedStorage, FailFastStorage, MemoryStorage, StorageUnavailable
+
+
+class TestMemoryStorage(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStorage()
+
+    def test_set_get(self):
+        self.assertTrue(self.store.set("key", 1.5))
+        self.assertEqual(self.store.get("key"), "1.5")
+        self.assertIsNone(self.store.get("missing"))
+        self.assertEqual(self.store.get_many(["key", "missing"]), ["1.5", None])
+
+    def test_set_many(self):
+        self.assertTrue(self.store.set_many({"a": 1, "b": 2.5}))
+        self.assertEqual(self.store.get_many(["a", "b"]), ["1", "2.5"])
+
+    def test_expired(self):
+        self.store.set("key", "value", 10)
+        with patch("store.time.monotonic", return_value=self.store.data["key"][1]):
+            self.assertIsNone(self.store.get("key"))
+
+
+class TestCachedStorage(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryStorage()
+        self.store = CachedStorage(self.backend, maxsize=2, ttl=10)
+
+    def test_read_through(self):
+        self.backend.set("key", "value")
+        self.assertEqual(self.store.get("key"), "value")
+        self.backend.data.clear()
+        self.assertEqual(self.store.get("key"), "value")
+        self.assertEqual((self.store.hits, self.store.misses), (1, 1))
+
+    def test_missing_not_cached(self):
+        self.assertIsNone(self.store.get("key"))
+        self.backend.set("key", "value")
+        self.assertEqual(self.store.get("key"), "value")
+        self.assertEqual((self.store.hits, self.store.misses), (0, 2))
+
+    def test_write_through(self):
+        self.store.set("key", 3.0, 60 * 60)
+        self.assertEqual(self.backend.get("key"), "3.0")
+        self.backend.data.clear()
+        self.assertEqual(self.store.get("key"), "3.0")
+        self.assertEqual(self.store.hits, 1)
+
+    def test_set_many(self):
+        self.store.set_many({"a": 1, "b": 2})
+        self.backend.data.clear()
+        self.assertEqual([self.store.get("a"), self.store.get("b")], ["1", "2"])
+        self.assertEqual(self.store.hits, 2)
+
+    def test_ttl(self):
+        self.backend.set("key", "value", 60 * 60)
+        self.store.get("key")
+        expires = self.store.entries["key"][1]
+        self.backend.set("key", "new value", 60 * 60)
+        with patch("store.time.monotonic", return_value=expires):
+            self.assertEqual(self.store.get("key"), "new value")
+        self.assertEqual((self.store.hits, self.store.misses), (0, 2))
+
+    def test_lru(self):
+        for key in ("a", "b"):
+            self.store.set(key, key)
+        self.store.get("a")
+        self.store.set("c", "c")
+        self.assertEqual(list(self.store.entries), ["a", "c"])
+
+    def test_stats(self):
+        self.store.set("key", "value")
+        self.store.get("key")
+        self.store.get("missing")
+        self.assertEqual(self.store.stats(), {"cache": {"hits": 1, "misses": 1, "size": 1}})
+
+    def test_close(self):
+        backend = MagicMock()
+        CachedStorage(FailFastStorage(backend)).close()
+        backend.close.assert_called_once_with()
+        # MemoryStorage has nothing to close
+        self.store.close()
+
+
+class TestFailFastStorage(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.store = FailFastStorage(self.backend, threshold=2, reset_timeout=10)
+
+    def test_opens_after_threshold(self):
+        self.backend.get.side_effect = RedisTimeoutError()
+        for _ in range(2):
+            self.assertRaises(RedisTimeoutError, self.store.get, "key")
+        self.assertRaises(StorageUnavailable, self.store.get, "key")
+        self.assertRaises(StorageUnavailable, self.store.set, "key", "value")
+        self.assertEqual(self.backend.get.call_count, 2)
+        self.backend.set.assert_not_called()
+
+    def test_probe_closes(self):
+        self.backend.get.side_effect = RedisConnectionError()
+        for _ in range(2):
+            self.assertRaises(RedisConnectionError, self.store.get, "key")
+        self.backend.get.side_effect = None
+        self.backend.get.return_value = "value"
+        with patch("store.time.monotonic", return_value=self.store.outage.retry_at):
+            self.assertEqual(self.store.get("key"), "value")
+        self.assertIsNone(self.store.outage.retry_at)
+        self.assertEqual(self.store.outage.failures, 0)
+        self.assertEqual(self.store.get("key"), "value")
+
+    def test_probe_fails(self):
+        self.backend.get.side_effect = RedisConnectionError()
+        for _ in range(2):
+            self.assertRaises(RedisConnectionError, self.store.get, "key")
+        retry_at = self.store.outage.retry_at
+        with patch("store.time.monotonic", return_value=retry_at):
+            self.assertRaises(RedisConnectionError, self.store.get, "key")
+            self.assertRaises(StorageUnavailable, self.store.get, "key")
+        self.assertEqual(self.store.outage.retry_at, retry_at + 10)
+        self.assertEqual(self.backend.get.call_count, 3)
+
+    def test_one_call_tries_the_storage(self):
+        self.backend.get.side_effect = RedisConnectionError()
+        for _ in range(2):
+            self.assertRaises(RedisConnectionError, self.store.get, "key")
+        retry_at = self.store.outage.retry_at
+        probe_started = threading.Event()
+        probe_done = threading.Event()
+
+        def slow_get(key):
+            probe_started.set()
+            probe_done.wait(5)
+            return "value"
+
+        self.backend.get.side_effect = slow_get
+        with patch("store.time.monotonic", return_value=retry_at):
+            probe = threading.Thread(target=self.store.get, args=("key",))
+            probe.start()
+            probe_started.wait(5)
+            self.assertRaises(StorageUnavailable, self.store.get, "key")
+            probe_done.set()
+            probe.join()
+        self.assertEqual(self.backend.get.call_count, 3)
+        self.assertEqual(self.store.get("key"), "value")
+
+    def test_other_errors_pass(self):
+        self.backend.get.side_effect = ValueError()
+        for _ in range(3):
+            self.assertRaises(ValueError, self.store.get, "key")
+        self.assertIsNone(self.store.outage.retry_at)
+
+    def test_score_computed_while_open(self):
+        self.backend.get.side_effect = RedisTimeoutError()
+        for _ in range(2):
+            self.assertRaises(RedisTimeoutError, self.store.get, "key")
+        self.assertEqual(get_score(self.store, "79175002040", "a@b.c"), 3.0)
+        self.assertEqual(self.backend.get.call_count, 2)
+        self.backend.set.assert_not_called()
@@ -1,12 +1,22 @@
 import argparse
+import asyncio
+from collections import OrderedDict
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import logging
+import logging.handlers
 import mimetypes
 import multiprocessing
 import os
+import queue
+import signal
 import socket
+import threading
+import time
 import traceback
-from typing import Optional
+from typing import List, Optional, Tuple
 from urllib.parse import unquote, urlparse
 
 HTTP_PROTOCOL = "HTTP/1.1"
@@ -15,35 +25,231 @@ MAX_NUM_CONNECTIONS = 5
 CHUNK_SIZE = 1024
 MAX_REQUEST_SIZE = 8192
 CONNETION_TIMEOUT_SEC = 2
+REQUEST_DEADLINE_SEC = 5
+IO_THREADS = 4
 HEADER_END_INDICATOR = "\r\n\r\n"
+ACCESS_LOGGER_NAME = "httpd.access"
+ACCESS_LOG_FORMAT = (
+    '%(client)s - - [%(asctime)s] "%(method)s %(path)s %(protocol)s" %(status)s '
+    '%(body_bytes_sent)s "%(http_referer)s" "%(http_user_agent)s"'
+)
+ACCESS_LOG_DATEFMT = "%d/%b/%Y:%H:%M:%S %z"
+LOG_BATCH_SIZE = 256
+STATUS_PATH = "/server-status"
+STATUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# contents of small files kept in memory by every worker
+FILE_CACHE_SIZE = 32 * 1024 * 1024
+FILE_CACHE_MAX_FILE_SIZE = 1024 * 1024
 
 HTTP_200_OK = 200
 HTTP_400_BAD_REQUEST = 400
 HTTP_403_FORBIDDEN = 403
 HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
+HTTP_503_SERVICE_UNAVAILABLE = 503
 RESPONSE_CODES = {
     HTTP_200_OK: "OK",
     HTTP_400_BAD_REQUEST: "Bad Request",
     HTTP_403_FORBIDDEN: "Forbidden",
     HTTP_404_NOT_FOUND: "Not Found",
     HTTP_405_METHOD_NOT_ALLOWED: "Method Not Allowed",
+    HTTP_503_SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 
 
+class ServerMetrics:
+    """Per-worker counters kept in shared memory and summed on read.
+
+    Every worker writes only to its own row of the array, so no locking is
+    needed on the hot path.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.codes = tuple(RESPONSE_CODES)
+        self.bytes_index = len(self.codes)
+        self.active_index = self.bytes_index + 1
+        self.latency_sum_index = self.active_index + 1
+        self.cache_hits_index = self.latency_sum_index + 1
+        self.cache_misses_index = self.cache_hits_index + 1
+        self.buckets_index = self.cache_misses_index + 1
+        self.row_size = self.buckets_index + len(LATENCY_BUCKETS_SEC) + 1
+        self.values = multiprocessing.RawArray("q", workers * self.row_size)
+
+    def worker(self, worker_id: int) -> "WorkerMetrics":
+        return WorkerMetrics(self, worker_id * self.row_size)
+
+    def totals(self) -> List[int]:
+        totals = [0] * self.row_size
+        for worker_id in range(self.workers):
+            offset = worker_id * self.row_size
+            for i, value in enumerate(self.values[offset : offset + self.row_size]):
+                totals[i] += value
+        return totals
+
+    def render(self) -> str:
+        totals = self.totals()
+        lines = [
+            "# HELP httpd_requests_total Handled requests by status code.",
+            "# TYPE httpd_requests_total counter",
+        ]
+        for i, code in enumerate(self.codes):
+            lines.append('httpd_requests_total{{code="{}"}} {}'.format(code, totals[i]))
+        lines += [
+            "# HELP httpd_sent_bytes_total Bytes sent to clients.",
+            "# TYPE httpd_sent_bytes_total counter",
+            "httpd_sent_bytes_total {}".format(totals[self.bytes_index]),
+            "# HELP httpd_active_connections Connections being served right now.",
+            "# TYPE httpd_active_connections gauge",
+            "httpd_active_connections {}".format(totals[self.active_index]),
+            "# HELP httpd_workers Number of worker processes.",
+            "# TYPE httpd_workers gauge",
+            "httpd_workers {}".format(self.workers),
+        ]
+        hits = totals[self.cache_hits_index]
+        misses = totals[self.cache_misses_index]
+        lines += [
+            "# HELP httpd_file_cache_reads_total File reads by file cache result.",
+            "# TYPE httpd_file_cache_reads_total counter",
+            'httpd_file_cache_reads_total{{result="hit"}} {}'.format(hits),
+            'httpd_file_cache_reads_total{{result="miss"}} {}'.format(misses),
+            "# HELP httpd_file_cache_hit_ratio Share of file reads served from memory.",
+            "# TYPE httpd_file_cache_hit_ratio gauge",
+            "httpd_file_cache_hit_ratio {}".format(
+                hits / (hits + misses) if hits + misses else 0.0
+            ),
+            "# HELP httpd_request_duration_seconds Request handling latency.",
+            "# TYPE httpd_request_duration_seconds histogram",
+        ]
+        count = 0
+        buckets = totals[self.buckets_index :]
+        for bound, observed in zip(LATENCY_BUCKETS_SEC + ("+Inf",), buckets):
+            count += observed
+            lines.append(
+                'httpd_request_duration_seconds_bucket{{le="{}"}} {}'.format(
+                    bound, count
+                )
+            )
+        lines += [
+            "httpd_request_duration_seconds_sum {}".format(
+                totals[self.latency_sum_index] / 1e6
+            ),
+            "httpd_request_duration_seconds_count {}".format(count),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class WorkerMetrics:
+    def __init__(self, metrics: ServerMetrics, offset: int) -> None:
+        self.metrics = metrics
+        self.values = metrics.values
+        self.offset = offset
+
+    def connection_opened(self) -> None:
+        self.values[self.offset + self.metrics.active_index] += 1
+
+    def connection_closed(self) -> None:
+        self.values[self.offset + self.metrics.active_index] -= 1
+
+    def cache_read(self, hit: bool) -> None:
+        metrics = self.metrics
+        index = metrics.cache_hits_index if hit else metrics.cache_misses_index
+        self.values[self.offset + index] += 1
+
+    def observe(self, code: int, bytes_sent: int, latency: float) -> None:
+        metrics, offset = self.metrics, self.offset
+        self.values[offset + metrics.codes.index(code)] += 1
+        self.values[offset + metrics.bytes_index] += bytes_sent
+        self.values[offset + metrics.latency_sum_index] += int(latency * 1e6)
+        bucket = len(LATENCY_BUCKETS_SEC)
+        for i, bound in enumerate(LATENCY_BUCKETS_SEC):
+            if latency <= bound:
+                bucket = i
+                break
+        self.values[offset + metrics.buckets_index + bucket] += 1
+
+
+class FileCache:
+    """LRU cache of small files of a worker, shared by its threads.
+
+    An entry is used while the file keeps its mtime and size, so a changed
+    file is read again. Reads and misses are counted in `worker_metrics`.
+    """
+
+    def __init__(
+        self,
+        max_size: int = FILE_CACHE_SIZE,
+        max_file_size: int = FILE_CACHE_MAX_FILE_SIZE,
+        worker_metrics: Optional[WorkerMetrics] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.worker_metrics = worker_metrics
+        self.entries: "OrderedDict[str, Tuple[int, int, bytes]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def read(self, path: str) -> bytes:
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            hit = entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size)
+            if hit:
+                self.entries.move_to_end(path)
+        if self.worker_metrics is not None:
+            self.worker_metrics.cache_read(hit)
+        if hit:
+            return entry[2]
+
+        with open(path, "rb") as file:
+            content = file.read()
+        with self.lock:
+            self.forget(path)
+            if len(content) <= self.max_file_size:
+                self.entries[path] = (stat.st_mtime_ns, stat.st_size, content)
+                self.size += len(content)
+                while self.size > self.max_size:
+                    self.forget(next(iter(self.entries)))
+        return content
+
+    def forget(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[2])
+
+
 class HTTPRequest:
     methods = ("GET", "HEAD")
 
-    def __init__(self, document_root):
+    def __init__(self, document_root, status_path=None):
         self.document_root = document_root
+        self.status_path = status_path
+        self.is_status = False
+        # the request target as sent by the client, for the access log
+        self.target = "-"
 
     def parse(self, request_data):
+        code, method, url, headers = self.parse_head(request_data)
+        if code is not None:
+            return code, method, url, headers
+
+        code, path = self.parse_url(url)
+
+        return code, method, path, headers
+
+    def parse_head(self, request_data):
+        """Parses the request without touching the filesystem.
+
+        The code is None for a file request, its url is resolved by parse_url.
+        """
         lines = request_data.split("\r\n")
         try:
             method, url, version = lines[0].split()
             method = method.upper()
         except ValueError:
             return HTTP_400_BAD_REQUEST, "?", "?", {}
+        self.target = url
 
         headers = {}
         for line in lines[1:]:
@@ -55,13 +261,15 @@ class HTTPRequest:
         if method not in self.methods:
             return HTTP_405_METHOD_NOT_ALLOWED, method, url, headers
 
-        code, path = self.parse_url(url)
+        if self.status_path and urlparse(url).path == self.status_path:
+            self.is_status = True
+            return HTTP_200_OK, method, self.status_path, headers
 
-        return code, method, path, headers
+        return None, method, url, headers
 
     def parse_url(self, url):
         parsed_path = unquote(urlparse(url).path)
-        logging.debug("Parsed request path: {}".format(parsed_path))
+        logging.debug("Parsed request path: %s", parsed_path)
         path = self.document_root + os.path.abspath(parsed_path)
 
         is_directory = os.path.isdir(path)
@@ -79,24 +287,47 @@ class HTTPRequest:
 
 
 class HTTPResponse:
-    def __init__(self, code, method, path, request_headers):
+    def __init__(
+        self,
+        code,
+        method,
+        path,
+        request_headers,
+        content=None,
+        content_type=None,
+        target="-",
+    ):
         self.code = code
         self.method = method
         self.path = path
+        self.target = target
         self.request_headers = request_headers
+        self.content = content
+        self.content_type = content_type
+        self.body_size = 0
+        self.header_size = 0
 
-    def process(self):
+    def process(self, cache: Optional[FileCache] = None):
         file_size = 0
         content_type = "text/plain"
         body = b""
-        if self.code == HTTP_200_OK:
+        if self.content is not None:
+            file_size = len(self.content)
+            content_type = self.content_type or content_type
+            if self.method == "GET":
+                body = self.content
+        elif self.code == HTTP_200_OK:
             file_size = self.request_headers.get(
                 "content-length", os.path.getsize(self.path)
             )
             if self.method == "GET":
                 content_type = mimetypes.guess_type(self.path)[0]
-                with open(self.path, "rb") as file:
-                    body = file.read(file_size)
+                if cache is not None:
+                    body = cache.read(self.path)
+                else:
+                    with open(self.path, "rb") as file:
+                        body = file.read(file_size)
+        self.body_size = len(body)
 
         first_line = "{} {} {}".format(
             HTTP_PROTOCOL, self.code, RESPONSE_CODES[self.code]
@@ -109,11 +340,9 @@ class HTTPResponse:
             "Content-Type": content_type,
         }
         headers = "\r\n".join("{}: {}".format(k, v) for k, v in headers.items())
-        response = (
-            "{}\r\n{}{}".format(first_line, headers, HEADER_END_INDICATOR).encode()
-            + body
-        )
-        return response
+        head = "{}\r\n{}{}".format(first_line, headers, HEADER_END_INDICATOR).encode()
+        self.header_size = len(head)
+        return head + body
 
 
 def receive(connection):
@@ -138,23 +367,233 @@ def receive(connection):
     return request
 
 
+async def receive_async(reader: asyncio.StreamReader) -> str:
+    try:
+        data = await asyncio.wait_for(
+            reader.readuntil(HEADER_END_INDICATOR.encode()), CONNETION_TIMEOUT_SEC
+        )
+    except asyncio.IncompleteReadError as e:
+        data = e.partial
+    except asyncio.LimitOverrunError:
+        data = await reader.read(MAX_REQUEST_SIZE)
+    except asyncio.TimeoutError:
+        logging.debug("Timeout for request recieving...")
+        data = b""
+    return data.decode()
+
+
+access_logger = logging.getLogger(ACCESS_LOGGER_NAME)
+
+
+def log_access(address: tuple, response: HTTPResponse, bytes_sent: int) -> None:
+    """Logs a response of which only `bytes_sent` bytes may have been sent."""
+    access_logger.info(
+        "",
+        extra={
+            "client": address[0],
+            "method": response.method,
+            "path": response.target,
+            "protocol": HTTP_PROTOCOL,
+            "status": response.code,
+            "body_bytes_sent": max(0, bytes_sent - response.header_size),
+            "http_referer": response.request_headers.get("referer", "-"),
+            "http_user_agent": response.request_headers.get("user-agent", "-"),
+        },
+    )
+
+
+def build_response(
+    request_data: str,
+    document_root: str,
+    metrics: Optional[ServerMetrics] = None,
+    cache: Optional[FileCache] = None,
+) -> Tuple[HTTPResponse, bytes]:
+    request = HTTPRequest(document_root, STATUS_PATH if metrics else None)
+    code, method, url, headers = request.parse_head(request_data)
+    if code is None:
+        return build_file_response(request, method, url, headers, cache)
+    return build_head_response(request, code, method, url, headers, metrics)
+
+
+def build_head_response(
+    request: HTTPRequest,
+    code: int,
+    method: str,
+    path: str,
+    headers: dict,
+    metrics: Optional[ServerMetrics] = None,
+) -> Tuple[HTTPResponse, bytes]:
+    """Response decided by parse_head alone, needs no filesystem access."""
+    if request.is_status:
+        response = HTTPResponse(
+            code,
+            method,
+            path,
+            headers,
+            content=metrics.render().encode(),
+            content_type=STATUS_CONTENT_TYPE,
+            target=request.target,
+        )
+    else:
+        response = HTTPResponse(code, method, path, headers, target=request.target)
+    return response, response.process()
+
+
+def build_file_response(
+    request: HTTPRequest,
+    method: str,
+    url: str,
+    headers: dict,
+    cache: Optional[FileCache] = None,
+) -> Tuple[HTTPResponse, bytes]:
+    code, path = request.parse_url(url)
+    response = HTTPResponse(code, method, path, headers, target=request.target)
+    return response, response.process(cache)
+
+
+async def run_in_pool(
+    executor: ThreadPoolExecutor, slots: asyncio.Semaphore, func, *args
+):
+    """Runs func in the executor once one of the slots is free.
+
+    A slot is held until func returns, even if the caller stopped waiting,
+    so jobs abandoned after a deadline can't pile up in the executor queue.
+    """
+    loop = asyncio.get_running_loop()
+    await slots.acquire()
+
+    def release(job) -> None:
+        try:
+            loop.call_soon_threadsafe(slots.release)
+        except RuntimeError:
+            # the loop is closed, nobody waits for the slot any more
+            pass
+
+    job = executor.submit(func, *args)
+    job.add_done_callback(release)
+    return await asyncio.wrap_future(job)
+
+
 def handle_request(
-    connection: socket.socket, address: tuple, document_root: str
+    connection: socket.socket,
+    address: tuple,
+    document_root: str,
+    metrics: Optional[ServerMetrics] = None,
+    worker_metrics: Optional[WorkerMetrics] = None,
+    cache: Optional[FileCache] = None,
 ) -> None:
+    started = time.monotonic()
+    if worker_metrics is not None:
+        worker_metrics.connection_opened()
+    response = None
+    sent = 0
     try:
         request_data = receive(connection)
-        request = HTTPRequest(document_root)
-        code, method, path, headers = request.parse(request_data)
-        response = HTTPResponse(code, method, path, headers)
-        response_data = response.process()
-
-        logging.info('"{} {} {}" {}'.format(method, path, HTTP_PROTOCOL, code))
-        connection.sendall(response_data)
-    except:
-        logging.exception("Error while sending response to {}".format(address))
+        response, response_data = build_response(
+            request_data, document_root, metrics, cache
+        )
+
+        # sendall does not tell how much was sent before a failure
+        data = memoryview(response_data)
+        while sent < len(data):
+            sent += connection.send(data[sent:])
+        if worker_metrics is not None:
+            worker_metrics.observe(
+                response.code, len(response_data), time.monotonic() - started
+            )
+    except Exception:
+        logging.exception("Error while sending response to %s", address)
     finally:
-        logging.debug("Closing socket for {}".format(address))
+        if response is not None:
+            log_access(address, response, sent)
+        logging.debug("Closing socket for %s", address)
         connection.close()
+        if worker_metrics is not None:
+            worker_metrics.connection_closed()
+
+
+async def handle_request_async(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    document_root: str,
+    executor: ThreadPoolExecutor,
+    io_slots: asyncio.Semaphore,
+    metrics: Optional[ServerMetrics] = None,
+    worker_metrics: Optional[WorkerMetrics] = None,
+    cache: Optional[FileCache] = None,
+) -> None:
+    """Serves a connection on the event loop, filesystem work goes to executor.
+
+    At most `io_slots` jobs are in the executor, requests waiting for a slot
+    longer than REQUEST_DEADLINE_SEC get 503.
+    """
+    started = time.monotonic()
+    address = writer.get_extra_info("peername")
+    logging.debug("Obtain request from %s", address)
+    if worker_metrics is not None:
+        worker_metrics.connection_opened()
+    response = None
+    sent = 0
+    try:
+        request_data = await receive_async(reader)
+        request = HTTPRequest(document_root, STATUS_PATH if metrics else None)
+        code, method, url, headers = request.parse_head(request_data)
+        if code is not None:
+            response, response_data = build_head_response(
+                request, code, method, url, headers, metrics
+            )
+        else:
+            try:
+                response, response_data = await asyncio.wait_for(
+                    run_in_pool(
+                        executor,
+                        io_slots,
+                        build_file_response,
+                        request,
+                        method,
+                        url,
+                        headers,
+                        cache,
+                    ),
+                    REQUEST_DEADLINE_SEC,
+                )
+            except asyncio.TimeoutError:
+                logging.error("Request deadline exceeded for %s", address)
+                response = HTTPResponse(
+                    HTTP_503_SERVICE_UNAVAILABLE,
+                    method,
+                    url,
+                    headers,
+                    target=request.target,
+                )
+                response_data = response.process()
+
+        writer.write(response_data)
+        # what the transport could not send right away is still buffered
+        sent = len(response_data) - writer.transport.get_write_buffer_size()
+        await writer.drain()
+        sent = len(response_data)
+        if worker_metrics is not None:
+            worker_metrics.observe(
+                response.code, len(response_data), time.monotonic() - started
+            )
+    except Exception:
+        logging.exception("Error while sending response to %s", address)
+    finally:
+        if response is not None:
+            log_access(address, response, sent)
+        logging.debug("Closing socket for %s", address)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        if worker_metrics is not None:
+            worker_metrics.connection_closed()
+
+
+class ServerStopped(Exception):
+    """Raised by the signal handler to leave a blocking accept()."""
 
 
 class HTTPServer:
@@ -164,11 +603,15 @@ class HTTPServer:
         port: int = 8080,
         document_root: str = DOCUMENT_ROOT,
         max_num_connections: int = 0,
+        metrics: Optional[ServerMetrics] = None,
+        io_threads: int = IO_THREADS,
     ) -> None:
         self.host = host
         self.port = port
         self.document_root = document_root
         self.max_num_connections = max_num_connections
+        self.metrics = metrics
+        self.io_threads = io_threads
 
     def run(self) -> None:
         try:
@@ -180,60 +623,228 @@ class HTTPServer:
         except socket.error as e:
             raise RuntimeError(e)
 
-    def serve_forever(self) -> None:
-        while True:
-            client_connection, client_address = self.socket.accept()
-            client_connection.settimeout(CONNETION_TIMEOUT_SEC)
-            logging.debug("Obtain request from {}".format(client_address))
-            handle_request(
-                client_connection,
-                client_address,
-                self.document_root,
+    def serve_forever(self, worker_id: int = 0) -> None:
+        worker_metrics = self.metrics.worker(worker_id) if self.metrics else None
+        cache = FileCache(worker_metrics=worker_metrics)
+        # the worker returns normally on SIGTERM and Ctrl+C, so that
+        # multiprocessing flushes the log records left in its queue
+        self.stopping = False
+        self.busy = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            while not self.stopping:
+                client_connection, client_address = self.socket.accept()
+                self.busy = True
+                client_connection.settimeout(CONNETION_TIMEOUT_SEC)
+                logging.debug("Obtain request from %s", client_address)
+                handle_request(
+                    client_connection,
+                    client_address,
+                    self.document_root,
+                    self.metrics,
+                    worker_metrics,
+                    cache,
+                )
+                self.busy = False
+        except ServerStopped:
+            logging.debug("Worker %s stopped", worker_id)
+
+    def stop(self, signum, frame) -> None:
+        """Stops at once while waiting for a connection, else after it."""
+        self.stopping = True
+        if not self.busy:
+            raise ServerStopped
+
+    def serve_forever_async(self, worker_id: int = 0) -> None:
+        asyncio.run(self._serve_async(worker_id))
+
+    async def _serve_async(self, worker_id: int) -> None:
+        worker_metrics = self.metrics.worker(worker_id) if self.metrics else None
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopping.set)
+        with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+            server = await asyncio.start_server(
+                partial(
+                    handle_request_async,
+                    document_root=self.document_root,
+                    executor=executor,
+                    io_slots=asyncio.Semaphore(self.io_threads),
+                    metrics=self.metrics,
+                    worker_metrics=worker_metrics,
+                    cache=FileCache(worker_metrics=worker_metrics),
+                ),
+                sock=self.socket,
+                limit=MAX_REQUEST_SIZE,
             )
-
-
-def run_server(host: str, port: int, workers: int, document_root: str):
+            async with server:
+                await stopping.wait()
+
+
+def run_server(
+    host: str,
+    port: int,
+    workers: int,
+    document_root: str,
+    mode: str = "prefork",
+    io_threads: int = IO_THREADS,
+):
     logging.info(
-        "Starting server at http://{}:{} with root dir - {}".format(
-            host, port, document_root
+        "Starting server at http://{}:{} with root dir - {} ({} mode)".format(
+            host, port, document_root, mode
         )
     )
-    server = HTTPServer(host, port, document_root)
+    server = HTTPServer(
+        host,
+        port,
+        document_root,
+        metrics=ServerMetrics(workers),
+        io_threads=io_threads,
+    )
     server.run()
+    target = server.serve_forever_async if mode == "asyncio" else server.serve_forever
 
     processes = []
     try:
-        for _ in range(workers):
-            process = multiprocessing.Process(target=server.serve_forever)
+        for worker_id in range(workers):
+            process = multiprocessing.Process(
+                target=target, args=(worker_id,)
+            )
             processes.append(process)
             process.start()
-            logging.debug("Worker with id {} was started".format(process.pid))
+            logging.debug("Worker with id %s was started", process.pid)
+        # SIGTERM stops the server like Ctrl+C does
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
         for process in processes:
             process.join()
     except KeyboardInterrupt:
         for process in processes:
-            if process:
-                process.terminate()
-                logging.debug("Worker with id {} was terminated".format(process.pid))
+            process.terminate()
+        # a worker flushes its log queue on the way out, wait for it
+        for process in processes:
+            process.join()
+            logging.debug("Worker with id %s was stopped", process.pid)
+
 
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Puts records to the queue, formatting is left to the LogWriter.
 
-def init_logging_config(filename: Optional[str] = None, level: str = "INFO") -> None:
+    Only the message is rendered here, like QueueHandler.prepare does, so
+    that unpicklable args and tracebacks never reach the queue.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class LogWriter(threading.Thread):
+    """Drains the log queue and writes records to the handlers in batches."""
+
+    def __init__(
+        self,
+        log_queue: multiprocessing.Queue,
+        handlers: List[logging.Handler],
+        batch_size: int = LOG_BATCH_SIZE,
+    ) -> None:
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+
+    def run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopped = None in batch
+            self.write([record for record in batch if record is not None])
+
+    def write(self, records: List[logging.LogRecord]) -> None:
+        # errors are reported like logging.Handler.emit does, a broken record
+        # or a failed write must not stop the thread
+        for handler in self.handlers:
+            lines = []
+            for record in records:
+                try:
+                    if record.levelno >= handler.level and handler.filter(record):
+                        lines.append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write("".join(lines))
+                handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+            finally:
+                handler.release()
+
+    def stop(self) -> None:
+        self.queue.put(None)
+        self.join()
+
+
+log_writer: Optional[LogWriter] = None
+
+
+def init_logging_config(
+    filename: Optional[str] = None,
+    level: str = "INFO",
+    access_log: Optional[str] = None,
+) -> bool:
+    global log_writer
     try:
+        main_handler = (
+            logging.FileHandler(filename) if filename else logging.StreamHandler()
+        )
+        main_handler.setFormatter(
+            logging.Formatter(
+                "[%(asctime)s] %(levelname).1s %(message)s", "%Y.%m.%d %H:%M:%S"
+            )
+        )
+        main_handler.addFilter(lambda record: record.name != ACCESS_LOGGER_NAME)
+
+        access_handler = (
+            logging.FileHandler(access_log) if access_log else logging.StreamHandler()
+        )
+        access_handler.setFormatter(
+            logging.Formatter(ACCESS_LOG_FORMAT, ACCESS_LOG_DATEFMT)
+        )
+        access_handler.addFilter(logging.Filter(ACCESS_LOGGER_NAME))
+
+        log_queue = multiprocessing.Queue()
         logging.basicConfig(
-            filename=filename,
-            filemode="a",
-            format="[%(asctime)s] %(levelname).1s %(message)s",
-            datefmt="%Y.%m.%d %H:%M:%S",
-            level=getattr(logging, level),
+            level=getattr(logging, level), handlers=[LazyQueueHandler(log_queue)]
         )
-    except TypeError:
+    except (TypeError, OSError):
         logging.error("Error initializing the logging system")
         traceback.print_stack()
         return False
 
+    log_writer = LogWriter(log_queue, [main_handler, access_handler])
+    log_writer.start()
     return True
 
 
+def shutdown_logging() -> None:
+    if log_writer is not None:
+        log_writer.stop()
+
+
 def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Basic http server")
 
@@ -249,6 +860,30 @@ def parse_arguments() -> argparse.Namespace:
         default=DOCUMENT_ROOT,
         help="Files root directory (DOCUMENT_ROOT)",
     )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=("prefork", "asyncio"),
+        default="prefork",
+        help="Serving mode: blocking workers or event loop with I/O thread pool",
+    )
+    parser.add_argument(
+        "-t",
+        "--io-threads",
+        type=int,
+        default=IO_THREADS,
+        help="Filesystem threads per worker in asyncio mode",
+    )
+    parser.add_argument(
+        "-l", "--log", type=str, default=None, help="Error log file (stderr if omitted)"
+    )
+    parser.add_argument(
+        "-a",
+        "--access-log",
+        type=str,
+        default=None,
+        help="Access log file (stderr if omitted)",
+    )
     parser.add_argument(
         "-d", "--debug", action="store_true", help="Show debug messages"
     )
@@ -260,7 +895,12 @@ def parse_arguments() -> argparse.Namespace:
 if __name__ == "__main__":
     args = parse_arguments()
     if args.debug:
-        init_logging_config(level="DEBUG")
+        init_logging_config(args.log, level="DEBUG", access_log=args.access_log)
     else:
-        init_logging_config(level="INFO")
-    run_server(args.host, args.port, args.workers, args.root)
+        init_logging_config(args.log, level="INFO", access_log=args.access_log)
+    try:
+        run_server(
+            args.host, args.port, args.workers, args.root, args.mode, args.io_threads
+        )
+    finally:
+        shutdown_logging()
@@ -0,0 +1,404 @@
+import asyncio
+import io
+import logging
+import os
+import pickle
+import queue
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest.mock import MagicMock, patch
+
+import httpd
+
+
+class CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, s):
+        self.writes += 1
+        return super().write(s)
+
+
+def make_record(msg, *args, level=logging.INFO):
+    return logging.LogRecord("httpd", level, __file__, 1, msg, args, None)
+
+
+def parse_metrics(text):
+    """Prometheus text format to {"name{labels}": value}, comments skipped"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = httpd.ServerMetrics(2)
+        first, second = self.metrics.worker(0), self.metrics.worker(1)
+        first.connection_opened()
+        first.observe(200, 1000, 0.003)
+        first.observe(404, 100, 0.02)
+        first.cache_read(True)
+        second.connection_opened()
+        second.connection_opened()
+        second.connection_closed()
+        second.observe(200, 500, 0.003)
+        second.observe(200, 10, 7.5)
+        second.cache_read(True)
+        second.cache_read(True)
+        second.cache_read(False)
+
+    def test_counters(self):
+        samples = parse_metrics(self.metrics.render())
+        self.assertEqual(samples['httpd_requests_total{code="200"}'], 3)
+        self.assertEqual(samples['httpd_requests_total{code="404"}'], 1)
+        self.assertEqual(samples['httpd_requests_total{code="503"}'], 0)
+        self.assertEqual(samples["httpd_sent_bytes_total"], 1610)
+        self.assertEqual(samples["httpd_active_connections"], 2)
+        self.assertEqual(samples["httpd_workers"], 2)
+
+    def test_histogram(self):
+        samples = parse_metrics(self.metrics.render())
+        bucket = 'httpd_request_duration_seconds_bucket{{le="{}"}}'.format
+        self.assertEqual(samples[bucket(0.005)], 2)
+        self.assertEqual(samples[bucket(0.01)], 2)
+        self.assertEqual(samples[bucket(0.025)], 3)
+        self.assertEqual(samples[bucket(5.0)], 3)
+        self.assertEqual(samples[bucket("+Inf")], 4)
+        counts = [samples[bucket(le)] for le in httpd.LATENCY_BUCKETS_SEC + ("+Inf",)]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(samples["httpd_request_duration_seconds_count"], 4)
+        self.assertAlmostEqual(
+            samples["httpd_request_duration_seconds_sum"], 7.526, places=6
+        )
+
+    def test_cache(self):
+        samples = parse_metrics(self.metrics.render())
+        self.assertEqual(samples['httpd_file_cache_reads_total{result="hit"}'], 3)
+        self.assertEqual(samples['httpd_file_cache_reads_total{result="miss"}'], 1)
+        self.assertEqual(samples["httpd_file_cache_hit_ratio"], 0.75)
+        empty = parse_metrics(httpd.ServerMetrics(1).render())
+        self.assertEqual(empty["httpd_file_cache_hit_ratio"], 0.0)
+
+    def test_server_status(self):
+        response, data = httpd.build_response(
+            "GET /server-status?x=1 HTTP/1.1\r\n\r\n", ".", self.metrics
+        )
+        self.assertEqual(response.code, 200)
+        head, body = data.split(b"\r\n\r\n", 1)
+        self.assertIn(b"Content-Type: " + httpd.STATUS_CONTENT_TYPE.encode(), head)
+        self.assertEqual(body.decode(), self.metrics.render())
+        # the endpoint is served only if metrics are on
+        response, _ = httpd.build_response(
+            "GET /server-status HTTP/1.1\r\n\r\n", "."
+        )
+        self.assertEqual(response.code, 404)
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.metrics = httpd.ServerMetrics(1)
+        self.cache = httpd.FileCache(
+            max_size=10, max_file_size=6, worker_metrics=self.metrics.worker(0)
+        )
+
+    def write(self, name, content, mtime=1000000000):
+        path = os.path.join(self.root.name, name)
+        with open(path, "wb") as fd:
+            fd.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def reads(self):
+        samples = parse_metrics(self.metrics.render())
+        return tuple(
+            samples['httpd_file_cache_reads_total{{result="{}"}}'.format(result)]
+            for result in ("hit", "miss")
+        )
+
+    def test_hit(self):
+        path = self.write("a", b"abc")
+        self.assertEqual(self.cache.read(path), b"abc")
+        self.assertEqual(self.cache.read(path), b"abc")
+        self.assertEqual(self.reads(), (1, 1))
+
+    def test_changed_file(self):
+        path = self.write("a", b"abc")
+        self.cache.read(path)
+        self.write("a", b"xyz", mtime=1000000001)
+        self.assertEqual(self.cache.read(path), b"xyz")
+        self.assertEqual(self.reads(), (0, 2))
+        self.assertEqual(self.cache.size, 3)
+
+    def test_large_file_not_kept(self):
+        path = self.write("a", b"abc")
+        self.cache.read(path)
+        self.write("a", b"too large", mtime=1000000001)
+        for _ in range(2):
+            self.assertEqual(self.cache.read(path), b"too large")
+        self.assertEqual(self.reads(), (0, 3))
+        self.assertEqual((len(self.cache.entries), self.cache.size), (0, 0))
+
+    def test_lru(self):
+        a, b, c = (self.write(name, b"1234") for name in "abc")
+        self.cache.read(a)
+        self.cache.read(b)
+        self.cache.read(a)
+        self.cache.read(c)
+        self.assertEqual(list(self.cache.entries), [a, c])
+        self.assertEqual(self.cache.size, 8)
+
+    def test_served_from_cache(self):
+        self.write("page.html", b"hello")
+        request = "GET /page.html HTTP/1.1\r\n\r\n"
+        for _ in range(2):
+            response, data = httpd.build_response(
+                request, self.root.name, cache=self.cache
+            )
+            self.assertTrue(data.endswith(b"\r\n\r\nhello"))
+        self.assertEqual(self.reads(), (1, 1))
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = CountingStream()
+        self.handler = logging.StreamHandler(self.stream)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.handler.handleError = MagicMock()
+        self.queue = queue.Queue()
+
+    def run_writer(self, records, batch_size):
+        for record in records:
+            self.queue.put(record)
+        writer = httpd.LogWriter(self.queue, [self.handler], batch_size=batch_size)
+        writer.start()
+        writer.stop()
+        self.assertFalse(writer.is_alive())
+
+    def test_batches(self):
+        self.run_writer([make_record("line %s", i) for i in range(5)], batch_size=2)
+        expected = "".join("line %s\n" % i for i in range(5))
+        self.assertEqual(self.stream.getvalue(), expected)
+        self.assertEqual(self.stream.writes, 3)
+
+    def test_level_and_filter(self):
+        self.handler.setLevel(logging.WARNING)
+        self.handler.addFilter(lambda record: "skip" not in record.msg)
+        self.run_writer(
+            [
+                make_record("info"),
+                make_record("error", level=logging.ERROR),
+                make_record("skip error", level=logging.ERROR),
+            ],
+            batch_size=10,
+        )
+        self.assertEqual(self.stream.getvalue(), "error\n")
+
+    def test_bad_record(self):
+        self.run_writer(
+            [make_record("%s and %s", 1), make_record("good")], batch_size=10
+        )
+        self.assertEqual(self.stream.getvalue(), "good\n")
+        self.handler.handleError.assert_called_once()
+
+    def test_failed_write(self):
+        self.stream.write = MagicMock(side_effect=OSError("disk full"))
+        self.queue.put(make_record("lost"))
+        self.queue.put(None)
+        writer = httpd.LogWriter(self.queue, [self.handler], batch_size=1)
+        writer.start()
+        writer.join(timeout=5)
+        self.assertFalse(writer.is_alive())
+        self.handler.handleError.assert_called_once()
+
+
+class LazyQueueHandlerTest(unittest.TestCase):
+    def test_prepare_renders_message(self):
+        handler = httpd.LazyQueueHandler(queue.Queue())
+        unpicklable = lambda: None  # noqa: E731
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.LogRecord(
+                "httpd", logging.ERROR, __file__, 1, "got %s", (unpicklable,), True
+            )
+            record.exc_info = sys.exc_info()
+        prepared = pickle.loads(pickle.dumps(handler.prepare(record)))
+        self.assertTrue(prepared.msg.startswith("got <function"))
+        self.assertIsNone(prepared.args)
+        self.assertIsNone(prepared.exc_info)
+        self.assertIn("ValueError: boom", prepared.exc_text)
+        self.assertEqual(record.args, (unpicklable,))
+
+
+class AccessLogTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.root.name, "file.html"), "wb") as fd:
+            fd.write(b"x" * 1000)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def handle(self, send, request=b"GET /file.html HTTP/1.1\r\n\r\n"):
+        connection = MagicMock()
+        connection.recv.return_value = request
+        connection.send.side_effect = send
+        with patch.object(httpd.access_logger, "info") as info:
+            httpd.handle_request(connection, ("127.0.0.1", 1), self.root.name)
+        connection.close.assert_called_once()
+        info.assert_called_once()
+        return info.call_args[1]["extra"]
+
+    def test_logged(self):
+        extra = self.handle(lambda data: len(data))
+        self.assertEqual((extra["status"], extra["body_bytes_sent"]), (200, 1000))
+
+    def test_request_target(self):
+        for request, target in (
+            (b"GET /file.html?v=1 HTTP/1.1\r\n\r\n", "/file.html?v=1"),
+            (b"GET /missing%20file HTTP/1.1\r\n\r\n", "/missing%20file"),
+            (b"POST /file.html HTTP/1.1\r\n\r\n", "/file.html"),
+            (b"garbage\r\n\r\n", "-"),
+        ):
+            extra = self.handle(lambda data: len(data), request)
+            self.assertEqual(extra["path"], target)
+
+    def test_logged_when_send_fails(self):
+        sends = [lambda data: len(data) - 400, BrokenPipeError()]
+
+        def send(data):
+            result = sends.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result(data)
+
+        with patch("logging.exception"):
+            extra = self.handle(send)
+        self.assertEqual((extra["status"], extra["body_bytes_sent"]), (200, 600))
+
+
+class ServerStopTest(unittest.TestCase):
+    def test_stop(self):
+        server = httpd.HTTPServer()
+        server.stopping = False
+        server.busy = True
+        # the current connection is served to the end
+        server.stop(signal.SIGTERM, None)
+        self.assertTrue(server.stopping)
+        server.busy = False
+        with self.assertRaises(httpd.ServerStopped):
+            server.stop(signal.SIGTERM, None)
+
+
+class AsyncServingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.root.name, "file.html"), "wb") as fd:
+            fd.write(b"hello")
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+        self.root.cleanup()
+
+    async def fetch(self, request, executor=None, **kwargs):
+        kwargs.setdefault("io_slots", asyncio.Semaphore(1))
+        server = await asyncio.start_server(
+            partial(
+                httpd.handle_request_async,
+                document_root=self.root.name,
+                executor=executor or self.executor,
+                **kwargs,
+            ),
+            "127.0.0.1",
+            0,
+        )
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            response = await reader.read()
+            writer.close()
+            await writer.wait_closed()
+        return response
+
+    async def test_file(self):
+        with patch.object(httpd.access_logger, "info"):
+            response = await self.fetch(b"GET /file.html HTTP/1.1\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(response.endswith(b"\r\n\r\nhello"))
+
+    async def test_parsed_on_loop(self):
+        executor = MagicMock()
+        with patch.object(httpd.access_logger, "info"):
+            response = await self.fetch(b"POST / HTTP/1.1\r\n\r\n", executor)
+        self.assertTrue(response.startswith(b"HTTP/1.1 405 "))
+        executor.submit.assert_not_called()
+
+    async def test_deadline(self):
+        slots = asyncio.Semaphore(1)
+        metrics = httpd.ServerMetrics(1)
+        release = threading.Event()
+        build_file_response = httpd.build_file_response
+
+        def blocked(*args):
+            release.wait(5)
+            return build_file_response(*args)
+
+        request = b"GET /file.html HTTP/1.1\r\n\r\n"
+        with patch.object(httpd, "REQUEST_DEADLINE_SEC", 0.1), patch.object(
+            httpd, "build_file_response", blocked
+        ), patch.object(httpd.access_logger, "info"), self.assertLogs(
+            level="ERROR"
+        ) as logs:
+            # the second request waits for the slot held by the first one
+            responses = await asyncio.gather(
+                self.fetch(request, io_slots=slots, worker_metrics=metrics.worker(0)),
+                self.fetch(request, io_slots=slots),
+            )
+        for response in responses:
+            self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('httpd_requests_total{code="503"} 1', metrics.render())
+
+        # the blocked job keeps its slot until it returns, the waiter left none
+        self.assertTrue(slots.locked())
+        release.set()
+        await asyncio.wait_for(slots.acquire(), 5)
+        self.assertTrue(slots.locked())
+        slots.release()
+        with patch.object(httpd.access_logger, "info"):
+            response = await self.fetch(request, io_slots=slots)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+
+    async def test_slot_held_after_deadline(self):
+        slots = asyncio.Semaphore(1)
+        release = threading.Event()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                httpd.run_in_pool(self.executor, slots, release.wait, 5), 0.05
+            )
+        # the abandoned job still runs and keeps its slot
+        self.assertTrue(slots.locked())
+        release.set()
+        await asyncio.wait_for(slots.acquire(), 5)
+        slots.release()
+        self.assertEqual(
+            await httpd.run_in_pool(self.executor, slots, sum, (1, 2)), 3
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
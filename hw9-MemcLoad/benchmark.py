@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Benchmarks for memc_load stages and the whole loader.
+
+    python benchmark.py parse --lines 1000000
+    python benchmark.py serialize --lines 1000000
+    python benchmark.py generate --files 4 --lines 1000000 --out /tmp/appsinstalled
+    python benchmark.py pipeline --pattern "/tmp/appsinstalled/*.tsv.gz" --fake \
+        --memc-args "--workers 4 --asyncio"
+
+`pipeline` first runs all stages in one thread, timing each of them, and
+then runs memc_load.main on copies of the files with --memc-args options.
+With --fake it starts fake_memcached.py on the addresses from those options.
+"""
+import os
+import sys
+import glob
+import gzip
+import time
+import shlex
+import random
+import shutil
+import socket
+import logging
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import appsinstalled_pb2
+import memc_load
+
+FAKE_MEMCACHED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_memcached.py")
+
+DEV_TYPES = (b"idfa", b"gaid", b"adid", b"dvid")
+
+
+def generate_lines(count, seed=42):
+    """Yields stripped lines in the sample.tsv format"""
+    rnd = random.Random(seed)
+    for i in range(count):
+        apps = b",".join(str(rnd.randint(1, 10000)).encode() for _ in range(rnd.randint(5, 50)))
+        yield b"\t".join((
+            rnd.choice(DEV_TYPES),
+            ("%016x" % rnd.getrandbits(64)).encode(),
+            ("%.6f" % rnd.uniform(-90, 90)).encode(),
+            ("%.6f" % rnd.uniform(-180, 180)).encode(),
+            apps,
+        ))
+
+
+def report(name, records, elapsed):
+    print("%-10s %10d records %8.3f sec %12.0f records/sec"
+          % (name, records, elapsed, records / elapsed if elapsed else 0))
+
+
+def report_stage(name, records, size, elapsed, total):
+    print("%-10s %8.3f sec %5.1f%% %12.0f records/sec %8.1f MB/sec"
+          % (name, elapsed, 100.0 * elapsed / total if total else 0,
+             records / elapsed if elapsed else 0, size / elapsed / 2 ** 20 if elapsed else 0))
+
+
+def parse_appsinstalled_baseline(line):
+    """parse_appsinstalled before the map(int) fast path, for comparison"""
+    line_parts = line.split(b"\t")
+    if len(line_parts) < 5:
+        return
+    dev_type, dev_id, lat, lon, raw_apps = line_parts[:5]
+    if not dev_type or not dev_id:
+        return
+    try:
+        apps = [int(a.strip()) for a in raw_apps.split(b",")]
+    except ValueError:
+        apps = [int(a.strip()) for a in raw_apps.split(b",") if a.strip().isdigit()]
+        logging.info("Not all user apps are digits: `%s`" % line)
+    try:
+        lat, lon = float(lat), float(lon)
+    except ValueError:
+        logging.info("Invalid geo coords: `%s`" % line)
+        return
+    return memc_load.AppsInstalled(dev_type, dev_id, lat, lon, apps)
+
+
+def bench_parse(opts):
+    """Times the baseline and the current parser on the same lines, best of interleaved rounds"""
+    lines = list(generate_lines(opts.lines, opts.seed))
+    parsers = (("baseline", parse_appsinstalled_baseline), ("parse", memc_load.parse_appsinstalled))
+    best = {}
+    for _ in range(opts.rounds):
+        for name, parse in parsers:
+            started = time.perf_counter()
+            for line in lines:
+                parse(line)
+            elapsed = time.perf_counter() - started
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name, _ in parsers:
+        report(name, len(lines), best[name])
+
+
+def bench_serialize(opts):
+    lines = list(generate_lines(opts.lines, opts.seed))
+    records = [memc_load.parse_appsinstalled(line) for line in lines]
+    records = [r for r in records if r]
+
+    started = time.time()
+    for r in records:
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = r.lat
+        ua.lon = r.lon
+        ua.apps.extend(r.apps)
+        ua.SerializeToString()
+    report("protobuf", len(records), time.time() - started)
+
+    ua = appsinstalled_pb2.UserApps()
+    started = time.time()
+    for r in records:
+        ua.Clear()
+        ua.lat = r.lat
+        ua.lon = r.lon
+        ua.apps.extend(r.apps)
+        ua.SerializeToString()
+    report("reused", len(records), time.time() - started)
+
+    started = time.time()
+    for r in records:
+        memc_load.pack_user_apps(r.apps, r.lat, r.lon)
+    report("packed", len(records), time.time() - started)
+
+
+def generate(opts):
+    if not os.path.isdir(opts.out):
+        os.makedirs(opts.out)
+    lines = generate_lines(opts.files * opts.lines, opts.seed)
+    for index in range(opts.files):
+        fn = os.path.join(opts.out, "appsinstalled-%04d.tsv.gz" % index)
+        with gzip.open(fn, "wb") as fd:
+            for _ in range(opts.lines):
+                fd.write(next(lines) + b"\n")
+        print("Generated %s" % fn)
+
+
+def start_fake_memcached(options, latency=0.0, failure_rate=0.0):
+    addrs = sorted(set(addr for addrs in memc_load.get_device_memc(options).values()
+                       for addr in addrs))
+    ports = [addr.rsplit(":", 1)[1] for addr in addrs]
+    proc = subprocess.Popen([sys.executable, FAKE_MEMCACHED, "--ports", ",".join(ports),
+                             "--latency", str(latency), "--failure-rate", str(failure_rate)],
+                            stderr=subprocess.DEVNULL)
+    deadline = time.time() + 5
+    for addr in addrs:
+        host, port = addr.rsplit(":", 1)
+        while True:
+            try:
+                socket.create_connection((host, int(port)), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    proc.kill()
+                    raise RuntimeError("Fake memcached did not start on %s" % addr)
+                time.sleep(0.05)
+    return proc
+
+
+def run_stages(files, options):
+    """Runs the loader stages one after another in a single thread"""
+    packed = memc_load.use_packed_serializer(options.serializer)
+    rings = dict((dev_type, memc_load.HashRing(memc_addrs))
+                 for dev_type, memc_addrs in memc_load.get_device_memc(options).items())
+    writers = dict((memc_addr, memc_load.MemcWriter(
+        memc_addr, dry_run=options.dry, batch_size=options.batch_size,
+        batch_bytes=options.batch_bytes, timeout=options.timeout, retries=options.retries,
+        backoff=options.backoff)) for ring in rings.values() for memc_addr in ring.nodes)
+    timings = dict.fromkeys(("decompress", "parse", "serialize", "send"), 0.0)
+    records = size = 0
+    for fn in files:
+        batches = memc_load.read_line_batches(fn, options.decompressor)
+        while True:
+            t0 = time.perf_counter()
+            lines = next(batches, None)
+            t1 = time.perf_counter()
+            timings["decompress"] += t1 - t0
+            if lines is None:
+                break
+            size += sum(len(line) + 1 for line in lines)
+            parsed = [memc_load.parse_appsinstalled(line.strip()) for line in lines if line]
+            t2 = time.perf_counter()
+            timings["parse"] += t2 - t1
+            serialized = [(appsinstalled.dev_type,
+                           memc_load.serialize_appsinstalled(appsinstalled, packed))
+                          for appsinstalled in parsed
+                          if appsinstalled and appsinstalled.dev_type in rings]
+            t3 = time.perf_counter()
+            timings["serialize"] += t3 - t2
+            for dev_type, (key, value) in serialized:
+                writers[rings[dev_type].get_node(key)].add(key, value)
+            records += len(serialized)
+            timings["send"] += time.perf_counter() - t3
+    started = time.perf_counter()
+    errors = 0
+    for writer in writers.values():
+        writer.close()
+        errors += writer.errors
+    timings["send"] += time.perf_counter() - started
+    return records, errors, size, timings
+
+
+def bench_pipeline(opts):
+    options, _ = memc_load.build_option_parser().parse_args(shlex.split(opts.memc_args))
+    files = sorted(glob.glob(opts.pattern))
+    if not files:
+        print("No files match %s" % opts.pattern)
+        sys.exit(1)
+    fake = start_fake_memcached(options, opts.latency, opts.failure_rate) if opts.fake else None
+    workdir = tempfile.mkdtemp(prefix="memc_bench_")
+    try:
+        records, errors, size, timings = run_stages(files, options)
+        total = sum(timings.values())
+        print("Stages, single thread: %s records, %s errors, %.1f MB of tsv"
+              % (records, errors, size / 2 ** 20))
+        for stage in ("decompress", "parse", "serialize", "send"):
+            report_stage(stage, records, size, timings[stage], total)
+        report_stage("total", records, size, total, total)
+
+        # main() renames loaded files, so it gets copies of them
+        for fn in files:
+            shutil.copy(fn, workdir)
+        options.pattern = os.path.join(workdir, "*")
+        started = time.perf_counter()
+        memc_load.main(options)
+        elapsed = time.perf_counter() - started
+        print("memc_load.main with %r:" % opts.memc_args)
+        report_stage("total", records, size, elapsed, elapsed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if fake:
+            fake.terminate()
+            fake.wait()
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "serialize": bench_serialize,
+    "generate": generate,
+    "pipeline": bench_pipeline,
+}
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="%prog [options] " + "|".join(sorted(BENCHMARKS)))
+    op.add_option("--lines", action="store", type="int", default=1000000)
+    op.add_option("--seed", action="store", type="int", default=42)
+    op.add_option("--rounds", action="store", type="int", default=5,
+                  help="parse: rounds per parser, the best one is reported")
+    op.add_option("--files", action="store", type="int", default=4, help="generate: files to write")
+    op.add_option("--out", action="store", default="/tmp/appsinstalled",
+                  help="generate: output directory")
+    op.add_option("--pattern", action="store", default="/tmp/appsinstalled/*.tsv.gz",
+                  help="pipeline: input files")
+    op.add_option("--memc-args", action="store", default="",
+                  help="pipeline: memc_load options, e.g. \"--workers 4 --asyncio\"")
+    op.add_option("--fake", action="store_true", default=False,
+                  help="pipeline: run against fake_memcached.py")
+    op.add_option("--latency", action="store", type="float", default=0.0,
+                  help="pipeline: fake memcached reply delay, seconds")
+    op.add_option("--failure-rate", action="store", type="float", default=0.0,
+                  help="pipeline: share of fake memcached writes which fail")
+    (opts, args) = op.parse_args()
+    if not args or args[0] not in BENCHMARKS:
+        op.print_usage()
+        sys.exit(2)
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    BENCHMARKS[args[0]](opts)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""In-memory stand-in for memcached, speaks the text protocol.
+
+Supports set/add/replace, get/gets, delete, stats, version and quit,
+which is enough for memc_load and python-memcached. Every reply can be
+delayed by --latency seconds and a --failure-rate share of storage
+commands is answered with SERVER_ERROR, to see how the loader behaves
+with slow or flapping nodes.
+
+    python fake_memcached.py --ports 33013,33014,33015,33016 --latency 0.001
+"""
+import sys
+import random
+import asyncio
+import logging
+from optparse import OptionParser
+
+STORAGE_COMMANDS = (b"set", b"add", b"replace")
+
+
+class FakeMemcachedProtocol(asyncio.Protocol):
+    def __init__(self, store, stats, latency=0.0, failure_rate=0.0):
+        self.store = store
+        self.stats = stats
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.buffer = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats["curr_connections"] += 1
+
+    def connection_lost(self, exc):
+        self.stats["curr_connections"] -= 1
+
+    def data_received(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        replies = []
+        start = 0
+        while True:
+            end = buffer.find(b"\r\n", start)
+            if end < 0:
+                break
+            parts = buffer[start:end].split()
+            if parts and parts[0] in STORAGE_COMMANDS:
+                # <cmd> <key> <flags> <exptime> <bytes> [noreply]\r\n<data>\r\n
+                try:
+                    size = int(parts[4])
+                except (IndexError, ValueError):
+                    replies.append(b"CLIENT_ERROR bad command line format\r\n")
+                    start = end + 2
+                    continue
+                if len(buffer) < end + 2 + size + 2:
+                    break
+                value = buffer[end + 2:end + 2 + size]
+                start = end + 2 + size + 2
+                reply = self.store_value(parts, value)
+                if parts[-1] != b"noreply":
+                    replies.append(reply)
+                continue
+            start = end + 2
+            if not parts:
+                continue
+            if parts[0] == b"quit":
+                self.transport.close()
+                return
+            replies.append(self.handle(parts))
+        self.buffer = buffer[start:]
+        if not replies:
+            return
+        data = b"".join(replies)
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self.write, data)
+        else:
+            self.write(data)
+
+    def write(self, data):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def store_value(self, parts, value):
+        command, key, flags = parts[0], parts[1], parts[2]
+        self.stats["cmd_set"] += 1
+        if self.failure_rate and random.random() < self.failure_rate:
+            return b"SERVER_ERROR out of memory storing object\r\n"
+        if command == b"add" and key in self.store:
+            return b"NOT_STORED\r\n"
+        if command == b"replace" and key not in self.store:
+            return b"NOT_STORED\r\n"
+        self.store[key] = (flags, value)
+        return b"STORED\r\n"
+
+    def handle(self, parts):
+        command = parts[0]
+        if command in (b"get", b"gets"):
+            replies = []
+            for key in parts[1:]:
+                self.stats["cmd_get"] += 1
+                if key in self.store:
+                    self.stats["get_hits"] += 1
+                    flags, value = self.store[key]
+                    replies.append(b"VALUE %s %s %d\r\n%s\r\n" % (key, flags, len(value), value))
+                else:
+                    self.stats["get_misses"] += 1
+            replies.append(b"END\r\n")
+            return b"".join(replies)
+        if command == b"delete" and len(parts) > 1:
+            return b"DELETED\r\n" if self.store.pop(parts[1], None) else b"NOT_FOUND\r\n"
+        if command == b"stats":
+            self.stats["curr_items"] = len(self.store)
+            return b"".join(b"STAT %s %d\r\n" % (name.encode(), value)
+                            for name, value in sorted(self.stats.items())) + b"END\r\n"
+        if command == b"version":
+            return b"VERSION fake-1.0\r\n"
+        return b"ERROR\r\n"
+
+
+async def serve(host, ports, latency=0.0, failure_rate=0.0):
+    loop = asyncio.get_running_loop()
+    servers = []
+    for port in ports:
+        # every port is a separate memcached instance with its own data
+        store = {}
+        stats = dict.fromkeys(("curr_connections", "curr_items", "cmd_set", "cmd_get",
+                               "get_hits", "get_misses"), 0)
+        servers.append(await loop.create_server(
+            lambda store=store, stats=stats: FakeMemcachedProtocol(store, stats, latency,
+                                                                   failure_rate),
+            host, port))
+        logging.info("Fake memcached listening on %s:%s" % (host, port))
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("--ports", action="store", default="33013,33014,33015,33016")
+    op.add_option("--latency", action="store", type="float", default=0.0,
+                  help="seconds to delay every reply")
+    op.add_option("--failure-rate", action="store", type="float", default=0.0,
+                  help="share of storage commands answered with SERVER_ERROR")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    ports = [int(port) for port in opts.ports.split(",")]
+    try:
+        asyncio.run(serve(opts.host, ports, opts.latency, opts.failure_rate))
+    except KeyboardInterrupt:
+        sys.exit(0)
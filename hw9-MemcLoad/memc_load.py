@@ -1,20 +1,57 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
 import os
-import gzip
 import sys
+import asyncio
+import zlib
 import glob
+import json
 import logging
 import collections
+import multiprocessing
+import multiprocessing.util
+import queue
+import threading
+import time
+import struct
+import bisect
+import hashlib
+import subprocess
 from optparse import OptionParser
+from shutil import which
 # brew install protobuf
 # protoc  --python_out=. ./appsinstalled.proto
 # pip install protobuf
 import appsinstalled_pb2
+from google.protobuf.internal import api_implementation
 # pip install python-memcached
 import memcache
 
 NORMAL_ERR_RATE = 0.01
+MEMC_BATCH_SIZE = 500
+MEMC_BATCH_BYTES = 512 * 1024
+# records handed to a writer thread at once and chunks waiting per address
+MEMC_CHUNK_SIZE = 100
+MEMC_QUEUE_SIZE = 64
+MEMC_SOCKET_TIMEOUT = 3
+MEMC_RETRIES = 3
+MEMC_BACKOFF = 0.1
+MEMC_BACKOFF_CAP = 5
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# asyncio mode: connections per address and pipelined requests per round trip
+MEMC_CONNECTIONS = 2
+MEMC_INFLIGHT = 100
+# chunks in flight or waiting per connection before parsing waits for them
+ASYNC_CHUNKS_PER_CONNECTION = 2
+GZIP_BLOCK_SIZE = 1024 * 1024
+# decompressed blocks buffered ahead of the parser in the "thread" mode
+DECOMPRESS_QUEUE_SIZE = 16
+DECOMPRESSORS = ("auto", "python", "thread", "pigz", "zcat")
+# seconds between progress reports of a file being loaded
+PROGRESS_INTERVAL = 30
+# libketama: 40 md5 digests per equally weighted node, 4 ring points from each
+KETAMA_HASHES_PER_NODE = 40
+KETAMA_POINTS = struct.Struct("<4I")
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
 
 
@@ -24,87 +61,1020 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(memc_addr, appsinstalled, dry_run=False):
+def iter_gzip_blocks(fn, block_size=GZIP_BLOCK_SIZE):
+    """Decompresses a (possibly multi-member) gzip file in large blocks"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(fn, "rb") as fd:
+        while True:
+            data = fd.read(block_size)
+            if not data:
+                break
+            block = b""
+            while data:
+                if decompressor.eof:
+                    # zero padding after a member is skipped, as gzip.open does
+                    data = data.lstrip(b"\0")
+                    if not data:
+                        break
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                block += decompressor.decompress(data)
+                data = decompressor.unused_data
+            if block:
+                yield block
+    if not decompressor.eof:
+        raise IOError("Unexpected end of gzip file %s" % fn)
+
+
+def iter_pipe_blocks(fn, tool, block_size=GZIP_BLOCK_SIZE):
+    """Lets an external pigz/zcat process do the decompression"""
+    proc = subprocess.Popen([tool, "-dc", fn], stdout=subprocess.PIPE, bufsize=block_size)
+    try:
+        while True:
+            block = proc.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        returncode = proc.wait()
+    if returncode:
+        raise IOError("%s failed on %s with code %s" % (tool, fn, returncode))
+
+
+def iter_background(blocks, maxsize=DECOMPRESS_QUEUE_SIZE):
+    """Runs the blocks generator in a thread, zlib releases the GIL meanwhile"""
+    results = queue.Queue(maxsize=maxsize)
+    # set when the consumer is gone, the producer must not block on a full queue
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put((block, None)):
+                    break
+            else:
+                put((None, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            # closes the file of the source generator
+            blocks.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block, error = results.get()
+            if error is not None:
+                raise error
+            if block is None:
+                break
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def read_line_batches(fn, decompressor="auto", block_size=GZIP_BLOCK_SIZE):
+    """Yields lists of lines of a .gz file, one list per decompressed block"""
+    if decompressor == "auto":
+        decompressor = "pigz" if which("pigz") else "thread"
+    if decompressor in ("pigz", "zcat"):
+        blocks = iter_pipe_blocks(fn, decompressor, block_size)
+    elif decompressor == "thread":
+        blocks = iter_background(iter_gzip_blocks(fn, block_size))
+    else:
+        blocks = iter_gzip_blocks(fn, block_size)
+    tail = b""
+    try:
+        for block in blocks:
+            lines = (tail + block).split(b"\n")
+            tail = lines.pop()
+            yield lines
+        if tail:
+            yield [tail]
+    finally:
+        blocks.close()
+
+
+def is_valid_memc_key(key):
+    """Checks a key the way python-memcached does: no spaces or control characters"""
+    return (len(key) <= memcache.SERVER_MAX_KEY_LENGTH
+            and memcache.valid_key_chars_re.match(key) is not None)
+
+
+def retry_delay(backoff, attempt):
+    """Exponential backoff before the attempt, the first retry waits `backoff`"""
+    return min(MEMC_BACKOFF_CAP, backoff * 2 ** (attempt - 1))
+
+
+def log_dry_run(memc_addr, records):
+    for key, packed in records:
+        ua = appsinstalled_pb2.UserApps()
+        ua.ParseFromString(packed)
+        logging.debug("%s - %s -> %s" % (memc_addr, key.decode(errors="replace"),
+                                         str(ua).replace("\n", " ")))
+
+
+def connect_memc(memc_addr, timeout=MEMC_SOCKET_TIMEOUT):
+    # dead_retry=0 lets a failed connection be reopened on the very next call
+    return memcache.Client([memc_addr], socket_timeout=timeout, dead_retry=0)
+
+
+class CircuitBreaker:
+    """Stops writes to a memcached address after repeated failures.
+
+    After `threshold` batches in a row fail, the breaker opens and batches
+    are failed without touching the network. Once `reset_timeout` seconds
+    pass, a single batch is let through to probe the node: success closes
+    the breaker, failure keeps it open for another `reset_timeout`.
+    """
+
+    def __init__(self, memc_addr, threshold=BREAKER_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.memc_addr = memc_addr
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def release_probe(self):
+        """Lets another batch probe the node if this one was not sent at all"""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info("Memc %s is back, resuming writes" % self.memc_addr)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None:
+                self.opened_at = time.time()
+            elif self.failures >= self.threshold:
+                self.opened_at = time.time()
+                logging.error("Memc %s is down, pausing writes for %s sec"
+                              % (self.memc_addr, self.reset_timeout))
+
+
+class MemcWriter:
+    """Buffers records for one memcached address and writes them with set_multi.
+
+    A batch is flushed when it reaches batch_size records or batch_bytes of
+    keys and values, whichever comes first. Keys which were not stored are
+    retried with exponential backoff, the breaker is shared by all writers
+    of the address.
+    """
+
+    def __init__(self, memc_addr, breaker=None, dry_run=False,
+                 batch_size=MEMC_BATCH_SIZE, batch_bytes=MEMC_BATCH_BYTES,
+                 timeout=MEMC_SOCKET_TIMEOUT, retries=MEMC_RETRIES, backoff=MEMC_BACKOFF):
+        self.memc_addr = memc_addr
+        self.memc = connect_memc(memc_addr, timeout)
+        self.breaker = breaker or CircuitBreaker(memc_addr)
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.buffer = {}
+        self.buffer_bytes = 0
+        self.pending = 0
+        self.processed = self.errors = 0
+        # set_multi calls and seconds spent in them, for progress reports
+        self.sends = 0
+        self.send_time = 0.0
+
+    def add(self, key, packed):
+        self.buffer[key] = packed
+        self.buffer_bytes += len(key) + len(packed)
+        self.pending += 1
+        if len(self.buffer) >= self.batch_size or self.buffer_bytes >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch, pending = self.buffer, self.pending
+        self.buffer, self.buffer_bytes, self.pending = {}, 0, 0
+        failed = self.send(batch)
+        self.processed += pending - len(failed)
+        self.errors += len(failed)
+
+    def send(self, batch):
+        """Returns the keys which were not stored"""
+        if self.dry_run:
+            log_dry_run(self.memc_addr, batch.items())
+            return []
+        if not self.breaker.allow():
+            return list(batch)
+        invalid = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(retry_delay(self.backoff, attempt))
+                # The connection may have been dropped by the server, reconnect
+                self.memc.disconnect_all()
+            started = time.time()
+            try:
+                failed, bad = self.set_multi(batch)
+            except OSError as e:
+                logging.error("Cannot write to memc %s: %s" % (self.memc_addr, e))
+                failed, bad = list(batch), []
+            except Exception as e:
+                # not a node failure: neither retried nor counted by the breaker
+                logging.exception("Cannot write to memc %s: %s" % (self.memc_addr, e))
+                self.breaker.release_probe()
+                return invalid + list(batch)
+            finally:
+                self.sends += 1
+                self.send_time += time.time() - started
+            invalid.extend(bad)
+            if not failed:
+                self.breaker.record_success()
+                return invalid
+            batch = dict((key, batch[key]) for key in failed)
+        self.breaker.record_failure()
+        logging.error("Cannot write %s keys to memc %s after %s retries"
+                      % (len(batch), self.memc_addr, self.retries))
+        return invalid + list(batch)
+
+    def set_multi(self, batch):
+        """Returns the keys which were not stored and the keys memcached can't take"""
+        try:
+            return self.memc.set_multi(batch), []
+        except memcache.Client.MemcachedKeyError:
+            # raised before anything is sent, only the offending keys are lost
+            valid, invalid = {}, []
+            for key, packed in batch.items():
+                try:
+                    self.memc.check_key(key)
+                except memcache.Client.MemcachedKeyError:
+                    invalid.append(key)
+                else:
+                    valid[key] = packed
+            if not invalid:
+                raise
+            logging.error("Skipping %s invalid keys for memc %s, e.g. %s"
+                          % (len(invalid), self.memc_addr, invalid[0].decode(errors="replace")))
+            return (self.memc.set_multi(valid) if valid else []), invalid
+
+    def close(self):
+        self.flush()
+        self.memc.disconnect_all()
+
+
+def _app_field(app):
+    """Tag of the `apps` field (1, varint) followed by the varint itself"""
+    field = bytearray(b"\x08")
+    while app > 0x7f:
+        field.append(app & 0x7f | 0x80)
+        app >>= 7
+    field.append(app)
+    return bytes(field)
+
+
+# `apps` is a proto2 repeated field without [packed=true], so every item is
+# encoded as a separate tag + varint; small ids are looked up in the table
+APP_FIELDS = [_app_field(app) for app in range(1 << 14)]
+# tags of `lat` (2, 64-bit) and `lon` (3, 64-bit) with little-endian doubles
+GEO_FIELDS = struct.Struct("<BdBd")
+UINT32_MAX = 0xffffffff
+
+
+def pack_user_apps(apps, lat, lon):
+    """Encodes UserApps by hand, the result is byte-identical to
+
+        UserApps(apps=apps, lat=lat, lon=lon).SerializeToString()
+
+    but does not build a message object (see prototest).
+    """
+    if apps and (min(apps) < 0 or max(apps) > UINT32_MAX):
+        raise ValueError("App id is out of uint32 range")
+    fields = APP_FIELDS
+    limit = len(fields)
+    packed = b"".join([fields[app] if app < limit else _app_field(app) for app in apps])
+    return packed + GEO_FIELDS.pack(0x11, lat, 0x19, lon)
+
+
+def serialize_appsinstalled(appsinstalled, packed=False):
+    key = b"%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
+    if packed:
+        return key, pack_user_apps(appsinstalled.apps, appsinstalled.lat, appsinstalled.lon)
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
     ua.lon = appsinstalled.lon
-    key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
     ua.apps.extend(appsinstalled.apps)
-    packed = ua.SerializeToString()
-    # @TODO persistent connection
-    # @TODO retry and timeouts!
-    try:
-        if dry_run:
-            logging.debug("%s - %s -> %s" % (memc_addr, key, str(ua).replace("\n", " ")))
-        else:
-            memc = memcache.Client([memc_addr])
-            memc.set(key, packed)
-    except Exception, e:
-        logging.exception("Cannot write to memc %s: %s" % (memc_addr, e))
-        return False
-    return True
+    return key, ua.SerializeToString()
+
+
+def use_packed_serializer(serializer="auto"):
+    # The hand-rolled encoder wins only over the pure Python protobuf, the
+    # upb/cpp backends serialize faster than it (see benchmark.py serialize)
+    if serializer == "auto":
+        return api_implementation.Type() == "python"
+    return serializer == "packed"
 
 
 def parse_appsinstalled(line):
-    line_parts = line.strip().split("\t")
+    """Parses a stripped bytes line, returns None for a malformed record"""
+    line_parts = line.split(b"\t")
     if len(line_parts) < 5:
         return
-    dev_type, dev_id, lat, lon, raw_apps = line_parts
+    dev_type, dev_id, lat, lon, raw_apps = line_parts[:5]
     if not dev_type or not dev_id:
         return
+    raw_apps = raw_apps.split(b",")
     try:
-        apps = [int(a.strip()) for a in raw_apps.split(",")]
+        # int() takes bytes and skips the whitespace around them
+        apps = list(map(int, raw_apps))
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
-        logging.info("Not all user apps are digits: `%s`" % line)
+        apps = [int(a) for a in (a.strip() for a in raw_apps) if a.isdigit()]
+        logging.info("Not all user apps are digits: `%s`" % line.decode(errors="replace"))
     try:
         lat, lon = float(lat), float(lon)
     except ValueError:
-        logging.info("Invalid geo coords: `%s`" % line)
+        logging.info("Invalid geo coords: `%s`" % line.decode(errors="replace"))
+        return
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
-def main(options):
-    device_memc = {
-        "idfa": options.idfa,
-        "gaid": options.gaid,
-        "adid": options.adid,
-        "dvid": options.dvid,
-    }
-    for fn in glob.iglob(options.pattern):
-        processed = errors = 0
-        logging.info('Processing %s' % fn)
-        fd = gzip.open(fn)
-        for line in fd:
-            line = line.strip()
-            if not line:
-                continue
-            appsinstalled = parse_appsinstalled(line)
-            if not appsinstalled:
-                errors += 1
-                continue
-            memc_addr = device_memc.get(appsinstalled.dev_type)
-            if not memc_addr:
-                errors += 1
-                logging.error("Unknow device type: %s" % appsinstalled.dev_type)
+class MemcWriterThread(threading.Thread):
+    """Takes chunks of (key, packed) records from the queue and writes them.
+
+    A barrier in the queue makes the thread flush its writer and wait on it,
+    None closes the writer and stops the thread.
+    """
+
+    def __init__(self, writer, jobs):
+        super().__init__()
+        self.daemon = True
+        self.writer = writer
+        self.jobs = jobs
+
+    def run(self):
+        while True:
+            chunk = self.jobs.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, threading.Barrier):
+                self.writer.flush()
+                chunk.wait()
                 continue
-            ok = insert_appsinstalled(memc_addr, appsinstalled, options.dry)
-            if ok:
-                processed += 1
-            else:
-                errors += 1
-        if not processed:
-            fd.close()
-            dot_rename(fn)
+            for key, packed in chunk:
+                self.writer.add(key, packed)
+        self.writer.close()
+
+
+class HashRing:
+    """Ketama consistent hashing of keys over memcached addresses.
+
+    The ring is built the way libketama does it for equally weighted
+    servers, so other ketama clients pick the same node for a key, and
+    adding or removing a node moves only about 1/N of the keys.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = list(collections.OrderedDict.fromkeys(nodes))
+        if not self.nodes:
+            raise ValueError("Hash ring needs at least one node")
+        ring = []
+        for node in self.nodes:
+            for i in range(KETAMA_HASHES_PER_NODE):
+                digest = hashlib.md5(("%s-%d" % (node, i)).encode()).digest()
+                ring.extend((point, node) for point in KETAMA_POINTS.unpack(digest))
+        ring.sort()
+        self.points = [point for point, _ in ring]
+        self.point_nodes = [node for _, node in ring]
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        point = KETAMA_POINTS.unpack(hashlib.md5(key).digest())[0]
+        index = bisect.bisect_left(self.points, point)
+        if index == len(self.points):
+            index = 0
+        return self.point_nodes[index]
+
+
+def get_device_memc(options):
+    """Maps a device type to its comma separated list of memcached addresses"""
+    return dict((dev_type, [addr.strip() for addr in addrs.split(",") if addr.strip()])
+                for dev_type, addrs in ((b"idfa", options.idfa), (b"gaid", options.gaid),
+                                        (b"adid", options.adid), (b"dvid", options.dvid)))
+
+
+def check_device_memc(options):
+    """Fails before the pool is started: a worker can't build an empty hash ring"""
+    empty = [dev_type.decode() for dev_type, memc_addrs in get_device_memc(options).items()
+             if not memc_addrs]
+    if empty:
+        raise ValueError("No memcached addresses for %s" % ", ".join(empty))
+
+
+def iter_records(lines, dev_types, packed=False):
+    """Yields (dev_type, (key, packed)) per line, or (None, None) for a bad one"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        appsinstalled = parse_appsinstalled(line)
+        if not appsinstalled:
+            yield None, None
+            continue
+        if appsinstalled.dev_type not in dev_types:
+            logging.error("Unknow device type: %s" % appsinstalled.dev_type.decode(errors="replace"))
+            yield None, None
             continue
+        try:
+            record = serialize_appsinstalled(appsinstalled, packed)
+        except Exception as e:
+            logging.exception("Cannot serialize %s: %s" % (appsinstalled.dev_id, e))
+            yield None, None
+            continue
+        yield appsinstalled.dev_type, record
+
+
+def log_error_rate(fn, processed, errors):
+    """Returns True if the file is loaded well enough to be dot-renamed"""
+    if not processed:
+        if errors:
+            logging.error("No records loaded, %s errors. Failed load %s" % (errors, fn))
+        return not errors
+    err_rate = float(errors) / processed
+    if err_rate < NORMAL_ERR_RATE:
+        logging.info("Acceptable error rate (%s). Successfull load %s" % (err_rate, fn))
+        return True
+    logging.error("High error rate (%s > %s). Failed load %s"
+                  % (err_rate, NORMAL_ERR_RATE, fn))
+    return False
+
+
+class FileProgress:
+    """Counters of a file being loaded, turned into progress snapshots.
+
+    Nodes are (memc_addr, stats, depth) triples: stats has processed,
+    errors, sends and send_time counters of a writer or a pool, depth
+    returns the number of records waiting for the node. Rates and
+    latencies in a snapshot are over the time since the previous one.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.started = time.time()
+        self.lines = self.bytes = self.bad = 0
+        self.decompress_time = 0.0
+        self.nodes = []
+        self.last = (self.started, 0, 0, {})
+
+    def track(self, batches):
+        """Counts lines and bytes of the batches and time spent waiting for them"""
+        while True:
+            started = time.time()
+            lines = next(batches, None)
+            self.decompress_time += time.time() - started
+            if lines is None:
+                return
+            self.lines += len(lines)
+            self.bytes += sum(map(len, lines)) + len(lines)
+            yield lines
+
+    def snapshot(self, done=False):
+        now = time.time()
+        last_time, last_lines, last_bytes, last_sends = self.last
+        interval = max(now - last_time, 1e-6)
+        nodes = {}
+        sends = {}
+        for memc_addr, stats, depth in self.nodes:
+            node = nodes.setdefault(memc_addr, {"processed": 0, "errors": 0, "queue": depth()})
+            node["processed"] += stats.processed
+            node["errors"] += stats.errors
+            count, spent = sends.get(memc_addr, (0, 0.0))
+            sends[memc_addr] = (count + stats.sends, spent + stats.send_time)
+        for memc_addr, (count, spent) in sends.items():
+            last_count, last_spent = last_sends.get(memc_addr, (0, 0.0))
+            nodes[memc_addr]["latency_ms"] = (
+                1000 * (spent - last_spent) / (count - last_count) if count > last_count else None)
+        self.last = (now, self.lines, self.bytes, sends)
+        processed = sum(node["processed"] for node in nodes.values())
+        errors = self.bad + sum(node["errors"] for node in nodes.values())
+        return {
+            "file": self.fn,
+            "done": done,
+            "elapsed": now - self.started,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "lines_per_sec": (self.lines - last_lines) / interval,
+            "bytes_per_sec": (self.bytes - last_bytes) / interval,
+            "processed": processed,
+            "errors": errors,
+            "error_rate": float(errors) / (processed + errors) if processed + errors else 0.0,
+            "decompress_time": self.decompress_time,
+            "nodes": nodes,
+        }
+
+
+def log_progress(snapshot):
+    nodes = ", ".join(
+        "%s queue %s latency %s" % (memc_addr, node["queue"], "-" if node["latency_ms"] is None
+                                     else "%.1f ms" % node["latency_ms"])
+        for memc_addr, node in sorted(snapshot["nodes"].items()))
+    logging.info("Progress %s: %s lines, %.0f lines/sec, %.2f MB/sec, error rate %.4f, "
+                 "%.1f sec in decompression; %s"
+                 % (snapshot["file"], snapshot["lines"], snapshot["lines_per_sec"],
+                    snapshot["bytes_per_sec"] / 2 ** 20, snapshot["error_rate"],
+                    snapshot["decompress_time"], nodes))
+
+
+class ProgressReporter(threading.Thread):
+    """Logs progress of a file every `interval` seconds.
+
+    Snapshots are also put to `stats`, a queue read by StatsFileWriter in
+    the parent process, if one is given.
+    """
+
+    def __init__(self, progress, interval=PROGRESS_INTERVAL, stats=None):
+        super().__init__()
+        self.daemon = True
+        self.progress = progress
+        self.interval = interval
+        self.stats = stats
+        self.stopped = threading.Event()
+
+    def run(self):
+        if self.interval <= 0:
+            return
+        while not self.stopped.wait(self.interval):
+            snapshot = self.progress.snapshot()
+            log_progress(snapshot)
+            if self.stats is not None:
+                self.stats.put(snapshot)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.stats is not None:
+            self.stats.put(self.progress.snapshot(done=True))
+
+
+class StatsFileWriter(threading.Thread):
+    """Keeps the latest snapshot of every file in a JSON stats file"""
+
+    def __init__(self, path, snapshots):
+        super().__init__()
+        self.daemon = True
+        self.path = path
+        self.snapshots = snapshots
+        self.files = {}
+
+    def run(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                break
+            self.files[snapshot["file"]] = snapshot
+            self.write()
+
+    def write(self):
+        files = self.files.values()
+        total = dict((key, sum(snapshot[key] for snapshot in files))
+                     for key in ("lines", "bytes", "processed", "errors"))
+        for key in ("lines_per_sec", "bytes_per_sec"):
+            total[key] = sum(snapshot[key] for snapshot in files if not snapshot["done"])
+        total["files_done"] = sum(snapshot["done"] for snapshot in files)
+        stats = {"updated": time.time(), "total": total, "files": self.files}
+        # readers never see a half-written file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(stats, fd, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class MemcNodes:
+    """Hash rings, breakers and writer threads of a worker process.
+
+    They live as long as the process, so memcached connections and the
+    breaker state are kept from one file to the next. Writer threads are
+    started by the first file loaded in the thread mode.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.rings = {}
+        self.breakers = {}
+        self.jobs = {}
+        self.threads = []
+        for dev_type, memc_addrs in get_device_memc(options).items():
+            self.rings[dev_type] = HashRing(memc_addrs)
+            for memc_addr in self.rings[dev_type].nodes:
+                if memc_addr not in self.breakers:
+                    self.breakers[memc_addr] = CircuitBreaker(
+                        memc_addr, options.breaker_threshold, options.breaker_timeout)
+
+    def start_writers(self):
+        if self.threads:
+            return
+        options = self.options
+        for memc_addr, breaker in self.breakers.items():
+            self.jobs[memc_addr] = queue.Queue(maxsize=MEMC_QUEUE_SIZE)
+            for _ in range(options.threads):
+                writer = MemcWriter(memc_addr, breaker, options.dry,
+                                    batch_size=options.batch_size, batch_bytes=options.batch_bytes,
+                                    timeout=options.timeout, retries=options.retries,
+                                    backoff=options.backoff)
+                thread = MemcWriterThread(writer, self.jobs[memc_addr])
+                thread.start()
+                self.threads.append(thread)
+
+    def reset_counters(self):
+        """Starts counting records of a new file, the writers must be flushed"""
+        for thread in self.threads:
+            writer = thread.writer
+            writer.processed = writer.errors = writer.sends = 0
+            writer.send_time = 0.0
+
+    def flush(self):
+        """Waits until everything queued so far is sent"""
+        barriers = []
+        for jobs in self.jobs.values():
+            # a thread waits on the barrier after its flush, so every thread
+            # of the address takes exactly one of them
+            barrier = threading.Barrier(self.options.threads + 1)
+            for _ in range(self.options.threads):
+                jobs.put(barrier)
+            barriers.append(barrier)
+        for barrier in barriers:
+            barrier.wait()
+
+    def close(self):
+        for jobs in self.jobs.values():
+            for _ in range(self.options.threads):
+                jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+# set in pool workers by init_worker, stats_queue only when --stats-file is given
+stats_queue = None
+memc_nodes = None
+
+
+def init_worker(options, stats):
+    global stats_queue, memc_nodes
+    stats_queue = stats
+    memc_nodes = MemcNodes(options)
+    # flush and disconnect the writers when the pool stops the worker
+    multiprocessing.util.Finalize(memc_nodes, memc_nodes.close, exitpriority=10)
+
+
+def get_memc_nodes(options):
+    global memc_nodes
+    if memc_nodes is None:
+        memc_nodes = MemcNodes(options)
+    return memc_nodes
+
+
+def process_file(fn, options):
+    nodes = get_memc_nodes(options)
+    nodes.start_writers()
+    nodes.reset_counters()
+    rings, node_jobs = nodes.rings, nodes.jobs
+    writers = [thread.writer for thread in nodes.threads]
+    progress = FileProgress(fn)
+    # queues hold chunks, the depth is reported in records like in the asyncio mode
+    progress.nodes = [(writer.memc_addr, writer,
+                       lambda jobs=node_jobs[writer.memc_addr]: jobs.qsize() * MEMC_CHUNK_SIZE)
+                      for writer in writers]
+    reporter = ProgressReporter(progress, options.progress_interval, stats_queue)
+    reporter.start()
+
+    processed = errors = 0
+    packed = use_packed_serializer(options.serializer)
+    chunks = collections.defaultdict(list)
+    logging.info('Processing %s' % fn)
+    batches = read_line_batches(fn, options.decompressor)
+    try:
+        for lines in progress.track(batches):
+            for dev_type, record in iter_records(lines, rings, packed):
+                if dev_type is None:
+                    errors += 1
+                    progress.bad += 1
+                    continue
+                memc_addr = rings[dev_type].get_node(record[0])
+                chunk = chunks[memc_addr]
+                chunk.append(record)
+                if len(chunk) >= MEMC_CHUNK_SIZE:
+                    node_jobs[memc_addr].put(chunk)
+                    chunks[memc_addr] = []
+    finally:
+        batches.close()
+        for memc_addr, jobs in node_jobs.items():
+            if chunks[memc_addr]:
+                jobs.put(chunks[memc_addr])
+        nodes.flush()
+        reporter.stop()
+    for writer in writers:
+        processed += writer.processed
+        errors += writer.errors
+
+    return processed, errors
+
+
+class AsyncMemcConnection:
+    """Memcached text protocol connection with pipelined set requests.
+
+    A chunk of requests is written at once and the replies, which
+    memcached sends back in order, are read after it.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.broken = False
+
+    @classmethod
+    async def open(cls, memc_addr, timeout=MEMC_SOCKET_TIMEOUT):
+        host, port = memc_addr.rsplit(":", 1)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+        return cls(reader, writer)
+
+    async def set_many(self, records, timeout=MEMC_SOCKET_TIMEOUT):
+        """Returns the keys which were not stored, keys must be valid"""
+        async with self.lock:
+            if self.broken:
+                raise ConnectionError("Memc connection is closed")
+            self.writer.write(b"".join(b"set %s 0 0 %d\r\n%s\r\n" % (key, len(value), value)
+                                       for key, value in records))
+            try:
+                replies = await asyncio.wait_for(self.read_replies(len(records)), timeout)
+            except (OSError, asyncio.TimeoutError):
+                # the rest of the replies can't be matched to requests any more
+                self.close()
+                raise
+        return [key for (key, _), reply in zip(records, replies) if reply != b"STORED\r\n"]
+
+    async def read_replies(self, count):
+        await self.writer.drain()
+        replies = []
+        for _ in range(count):
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Connection closed by memc")
+            replies.append(line)
+        return replies
+
+    def close(self):
+        self.broken = True
+        self.writer.close()
+
+
+class AsyncMemcPool:
+    """Round-robin over a fixed number of connections to one address.
+
+    Chunks of records are sent in background tasks by submit(), which
+    waits only when ASYNC_CHUNKS_PER_CONNECTION chunks per connection are
+    already in flight, so records are parsed while earlier ones are sent.
+    Chunks are retried and go through the breaker like in MemcWriter.
+    A broken connection is replaced by a new one on the next request.
+    """
+
+    def __init__(self, memc_addr, breaker=None, dry_run=False, size=MEMC_CONNECTIONS,
+                 timeout=MEMC_SOCKET_TIMEOUT, retries=MEMC_RETRIES, backoff=MEMC_BACKOFF):
+        self.memc_addr = memc_addr
+        self.breaker = breaker or CircuitBreaker(memc_addr)
+        self.dry_run = dry_run
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = [None] * size
+        self.next = 0
+        self.slots = asyncio.Semaphore(size * ASYNC_CHUNKS_PER_CONNECTION)
+        self.tasks = set()
+        self.processed = self.errors = 0
+        self.sends = 0
+        self.send_time = 0.0
+        # records sent and waiting for replies
+        self.inflight = 0
+
+    async def submit(self, records):
+        await self.slots.acquire()
+        self.inflight += len(records)
+        task = asyncio.ensure_future(self.set_many(records))
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        # let the task write its requests before parsing goes on
+        await asyncio.sleep(0)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        self.slots.release()
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def set_many(self, records):
+        try:
+            failed = await self.send_with_retries(records)
+        finally:
+            self.inflight -= len(records)
+        self.processed += len(records) - len(failed)
+        self.errors += len(failed)
+
+    async def send_with_retries(self, records):
+        """Returns the keys which were not stored"""
+        invalid = [key for key, _ in records if not is_valid_memc_key(key)]
+        if invalid:
+            logging.error("Skipping %s invalid keys for memc %s, e.g. %s"
+                          % (len(invalid), self.memc_addr, invalid[0].decode(errors="replace")))
+            records = [(key, packed) for key, packed in records if is_valid_memc_key(key)]
+        if self.dry_run:
+            log_dry_run(self.memc_addr, records)
+            return invalid
+        if not records:
+            return invalid
+        if not self.breaker.allow():
+            return invalid + [key for key, _ in records]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(retry_delay(self.backoff, attempt))
+            started = time.time()
+            try:
+                failed = await self.send(records)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.error("Cannot write to memc %s: %s"
+                              % (self.memc_addr, e or type(e).__name__))
+                failed = [key for key, _ in records]
+            self.sends += 1
+            self.send_time += time.time() - started
+            if not failed:
+                self.breaker.record_success()
+                return invalid
+            failed = set(failed)
+            records = [(key, packed) for key, packed in records if key in failed]
+        self.breaker.record_failure()
+        logging.error("Cannot write %s keys to memc %s after %s retries"
+                      % (len(records), self.memc_addr, self.retries))
+        return invalid + [key for key, _ in records]
 
-        err_rate = float(errors) / processed
-        if err_rate < NORMAL_ERR_RATE:
-            logging.info("Acceptable error rate (%s). Successfull load" % err_rate)
+    async def send(self, records):
+        index = self.next
+        self.next = (index + 1) % len(self.connections)
+        opening = self.connections[index]
+        if opening is None or opening.done() and (
+                opening.cancelled() or opening.exception() or opening.result().broken):
+            opening = asyncio.ensure_future(AsyncMemcConnection.open(self.memc_addr, self.timeout))
+            self.connections[index] = opening
+        connection = await opening
+        return await connection.set_many(records, self.timeout)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for opening in self.connections:
+            if opening is None:
+                continue
+            if not opening.done():
+                opening.cancel()
+            elif not opening.cancelled() and not opening.exception():
+                opening.result().close()
+
+
+async def process_file_async(fn, options):
+    # connections belong to the event loop of the file, breakers to the worker
+    nodes = get_memc_nodes(options)
+    rings = nodes.rings
+    pools = dict((memc_addr, AsyncMemcPool(memc_addr, breaker, options.dry, options.connections,
+                                           options.timeout, options.retries, options.backoff))
+                 for memc_addr, breaker in nodes.breakers.items())
+    progress = FileProgress(fn)
+    progress.nodes = [(memc_addr, pool, lambda pool=pool: pool.inflight)
+                      for memc_addr, pool in pools.items()]
+    reporter = ProgressReporter(progress, options.progress_interval, stats_queue)
+    reporter.start()
+    loop = asyncio.get_running_loop()
+    errors = 0
+    packed = use_packed_serializer(options.serializer)
+    chunks = collections.defaultdict(list)
+    logging.info('Processing %s' % fn)
+    batches = read_line_batches(fn, options.decompressor)
+    tracked = progress.track(batches)
+    try:
+        while True:
+            # decompression blocks, keep it off the event loop
+            lines = await loop.run_in_executor(None, next, tracked, None)
+            if lines is None:
+                break
+            for dev_type, record in iter_records(lines, rings, packed):
+                if dev_type is None:
+                    errors += 1
+                    progress.bad += 1
+                    continue
+                memc_addr = rings[dev_type].get_node(record[0])
+                chunk = chunks[memc_addr]
+                chunk.append(record)
+                if len(chunk) >= options.inflight:
+                    await pools[memc_addr].submit(chunk)
+                    chunks[memc_addr] = []
+        for memc_addr, chunk in chunks.items():
+            if chunk:
+                await pools[memc_addr].submit(chunk)
+        for pool in pools.values():
+            await pool.join()
+    finally:
+        batches.close()
+        for pool in pools.values():
+            pool.close()
+        reporter.stop()
+
+    processed = sum(pool.processed for pool in pools.values())
+    errors += sum(pool.errors for pool in pools.values())
+    return processed, errors
+
+
+def load_file(args):
+    """Pool task: returns (index, ok) so the parent can restore file order.
+
+    ok is False if the file failed to load or has a high error rate, such
+    a file is not renamed and is loaded again by the next run.
+    """
+    index, fn, options = args
+    try:
+        if options.asyncio:
+            processed, errors = asyncio.run(process_file_async(fn, options))
         else:
-            logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
-        fd.close()
-        dot_rename(fn)
+            processed, errors = process_file(fn, options)
+    except Exception as e:
+        logging.exception("Cannot process %s: %s" % (fn, e))
+        return index, False
+    logging.info("Done %s: %s records loaded, %s errors" % (fn, processed, errors))
+    return index, log_error_rate(fn, processed, errors)
+
+
+def main(options):
+    check_device_memc(options)
+    files = sorted(glob.iglob(options.pattern))
+    # Files finish in any order, but are dot-renamed strictly in sorted order:
+    # results wait in `finished` until every earlier file is done as well
+    finished = {}
+    next_index = 0
+    broken = None
+    stats, stats_writer = None, None
+    if options.stats_file:
+        stats = multiprocessing.Queue()
+        stats_writer = StatsFileWriter(options.stats_file, stats)
+        stats_writer.start()
+    pool = multiprocessing.Pool(options.workers, initializer=init_worker,
+                                initargs=(options, stats))
+    try:
+        jobs = ((index, fn, options) for index, fn in enumerate(files))
+        for index, ok in pool.imap_unordered(load_file, jobs):
+            finished[index] = ok
+            while next_index in finished:
+                fn = files[next_index]
+                if not finished.pop(next_index) and broken is None:
+                    broken = fn
+                if broken is None:
+                    dot_rename(fn)
+                elif broken != fn:
+                    logging.error("Leaving %s unrenamed, %s failed to load" % (fn, broken))
+                next_index += 1
+    finally:
+        pool.close()
+        pool.join()
+        if stats_writer:
+            stats.put(None)
+            stats_writer.join()
 
 
 def prototest():
@@ -121,9 +1091,13 @@ def prototest():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        assert pack_user_apps(apps, lat, lon) == packed
+    for apps in ([], [0], [127, 128, 16383, 16384], [2 ** 21, 2 ** 28, UINT32_MAX]):
+        ua = appsinstalled_pb2.UserApps(apps=apps, lat=-0.5, lon=1e300)
+        assert pack_user_apps(apps, -0.5, 1e300) == ua.SerializeToString()
 
 
-if __name__ == '__main__':
+def build_option_parser():
     op = OptionParser()
     op.add_option("-t", "--test", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
@@ -132,17 +1106,58 @@ if __name__ == '__main__':
     op.add_option("--idfa", action="store", default="127.0.0.1:33013")
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
-    op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--dvid", action="store", default="127.0.0.1:33016",
+                  help="every device type option takes a comma separated list of nodes, "
+                       "keys are spread over them with ketama consistent hashing")
+    op.add_option("--decompressor", action="store", type="choice", choices=DECOMPRESSORS,
+                  default="auto", help="auto picks pigz if installed, else a background thread")
+    op.add_option("--serializer", action="store", type="choice",
+                  choices=("auto", "protobuf", "packed"), default="auto",
+                  help="auto uses the hand-rolled encoder with pure Python protobuf only")
+    op.add_option("--batch-size", action="store", type="int", default=MEMC_BATCH_SIZE)
+    op.add_option("--batch-bytes", action="store", type="int", default=MEMC_BATCH_BYTES)
+    op.add_option("--workers", action="store", type="int", default=multiprocessing.cpu_count(),
+                  help="processes loading files in parallel")
+    op.add_option("--threads", action="store", type="int", default=2,
+                  help="writer threads per memcached address in each process")
+    op.add_option("--asyncio", action="store_true", default=False,
+                  help="write with pipelined asyncio connections instead of threads")
+    op.add_option("--connections", action="store", type="int", default=MEMC_CONNECTIONS,
+                  help="asyncio mode: connections per memcached address")
+    op.add_option("--inflight", action="store", type="int", default=MEMC_INFLIGHT,
+                  help="asyncio mode: set requests pipelined in one round trip")
+    op.add_option("--timeout", action="store", type="float", default=MEMC_SOCKET_TIMEOUT,
+                  help="memcached socket timeout, seconds")
+    op.add_option("--retries", action="store", type="int", default=MEMC_RETRIES)
+    op.add_option("--backoff", action="store", type="float", default=MEMC_BACKOFF,
+                  help="first retry delay, doubled on every next attempt")
+    op.add_option("--breaker-threshold", action="store", type="int", default=BREAKER_THRESHOLD,
+                  help="failed batches in a row before writes to a node are paused")
+    op.add_option("--breaker-timeout", action="store", type="float", default=BREAKER_RESET_TIMEOUT,
+                  help="seconds to pause writes to a failed node")
+    op.add_option("--progress-interval", action="store", type="float", default=PROGRESS_INTERVAL,
+                  help="seconds between progress reports of every file, 0 disables them")
+    op.add_option("--stats-file", action="store", default=None,
+                  help="JSON file updated with the latest progress of all files")
+    return op
+
+
+if __name__ == '__main__':
+    op = build_option_parser()
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
     if opts.test:
         prototest()
         sys.exit(0)
+    try:
+        check_device_memc(opts)
+    except ValueError as e:
+        op.error(str(e))
 
     logging.info("Memc loader started with options: %s" % opts)
     try:
         main(opts)
-    except Exception, e:
+    except Exception as e:
         logging.exception("Unexpected error: %s" % e)
         sys.exit(1)
@@ -0,0 +1,607 @@
+import asyncio
+import gc
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+import warnings
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import fake_memcached
+import memc_load
+
+
+NODES = ["10.0.0.1:11211", "10.0.0.2:11211", "10.0.0.3:11211"]
+
+
+class HashRingTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = memc_load.HashRing(NODES)
+
+    def test_points(self):
+        # libketama: 40 md5 digests of "<node>-<i>" per node, 4 little-endian points each
+        self.assertEqual(len(self.ring.points), 3 * 160)
+        self.assertEqual(self.ring.points, sorted(self.ring.points))
+        for point in (1644766326, 266575842, 1549369152, 2004188753):  # md5("10.0.0.1:11211-0")
+            self.assertEqual(self.ring.point_nodes[self.ring.points.index(point)], NODES[0])
+
+    def test_vectors(self):
+        # the key point is the first 4 bytes of md5(key), little-endian, e.g.
+        # md5(b"foo") = acbd18db... -> 0xdb18bdac; the node of the next ring point wins
+        vectors = {
+            b"foo": "10.0.0.3:11211",
+            b"bar": "10.0.0.1:11211",
+            b"idfa:1rfw452y52g2gq4g": "10.0.0.2:11211",
+            b"gaid:7rfw452y52g2gq4g": "10.0.0.1:11211",
+            b"adid:x": "10.0.0.2:11211",
+        }
+        for key, node in vectors.items():
+            self.assertEqual(self.ring.get_node(key), node, key)
+
+    def test_matches_linear_search(self):
+        ring = sorted(zip(self.ring.points, self.ring.point_nodes))
+        for i in range(2000):
+            key = b"idfa:%d" % i
+            point = int.from_bytes(hashlib.md5(key).digest()[:4], "little")
+            # past the last point the ring wraps around to the first one
+            expected = next((node for ring_point, node in ring if ring_point >= point), ring[0][1])
+            self.assertEqual(self.ring.get_node(key), expected, key)
+
+    def test_single_node(self):
+        self.assertEqual(memc_load.HashRing(["127.0.0.1:33013"]).get_node(b"foo"),
+                         "127.0.0.1:33013")
+        with self.assertRaises(ValueError):
+            memc_load.HashRing([])
+
+    def test_added_node_takes_its_share(self):
+        bigger = memc_load.HashRing(NODES + ["10.0.0.4:11211"])
+        keys = [b"gaid:%d" % i for i in range(10000)]
+        moved = [key for key in keys if self.ring.get_node(key) != bigger.get_node(key)]
+        self.assertTrue(all(bigger.get_node(key) == "10.0.0.4:11211" for key in moved))
+        self.assertAlmostEqual(len(moved) / len(keys), 0.25, delta=0.1)
+
+
+class PackUserAppsTest(unittest.TestCase):
+    def assertPacked(self, apps, lat, lon):
+        ua = memc_load.appsinstalled_pb2.UserApps(apps=apps, lat=lat, lon=lon)
+        self.assertEqual(memc_load.pack_user_apps(apps, lat, lon), ua.SerializeToString())
+
+    def test_matches_protobuf(self):
+        for apps in ([], [0], [1, 2, 3], [127, 128, 16383], [2 ** 14, 2 ** 21 - 1, 2 ** 21],
+                     [2 ** 28, 2 ** 31, memc_load.UINT32_MAX], list(range(0, 70000, 997))):
+            self.assertPacked(apps, 55.55, 42.42)
+        for lat, lon in ((0.0, -0.0), (-90.0, 180.0), (1e300, -1e-300)):
+            self.assertPacked([1], lat, lon)
+
+    def test_table_boundary(self):
+        self.assertEqual(len(memc_load.APP_FIELDS), 2 ** 14)
+        self.assertEqual(memc_load.pack_user_apps([2 ** 14 - 1, 2 ** 14], 0, 0)[:7],
+                         b"\x08\xff\x7f\x08\x80\x80\x01")
+        self.assertEqual(memc_load.pack_user_apps([memc_load.UINT32_MAX], 0, 0)[:6],
+                         b"\x08\xff\xff\xff\xff\x0f")
+
+    def test_out_of_range(self):
+        for apps in ([-1], [2 ** 32]):
+            with self.assertRaises(ValueError):
+                memc_load.pack_user_apps(apps, 0, 0)
+
+    def test_serialize_appsinstalled(self):
+        appsinstalled = memc_load.AppsInstalled(b"idfa", b"dev1", 1.5, 2.5, [1, 300000])
+        self.assertEqual(memc_load.serialize_appsinstalled(appsinstalled, packed=True),
+                         memc_load.serialize_appsinstalled(appsinstalled, packed=False))
+
+
+class GzipBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def read(self, data, block_size=7):
+        fn = os.path.join(self.workdir, "data.gz")
+        with open(fn, "wb") as fd:
+            fd.write(data)
+        with gzip.open(fn) as fd:
+            expected = fd.read()
+        self.assertEqual(b"".join(memc_load.iter_gzip_blocks(fn, block_size)), expected)
+        self.assertEqual(b"".join(memc_load.iter_gzip_blocks(fn)), expected)
+        return expected
+
+    def test_members(self):
+        first, second = gzip.compress(b"first\n" * 10), gzip.compress(b"second\n")
+        self.assertEqual(self.read(first), b"first\n" * 10)
+        self.assertEqual(self.read(first + second), b"first\n" * 10 + b"second\n")
+        self.assertEqual(self.read(first + gzip.compress(b"") + second),
+                         b"first\n" * 10 + b"second\n")
+
+    def test_zero_padding(self):
+        first, second = gzip.compress(b"first\n"), gzip.compress(b"second\n")
+        self.assertEqual(self.read(first + b"\0" * 20), b"first\n")
+        self.assertEqual(self.read(first + b"\0" * 20 + second + b"\0"), b"first\nsecond\n")
+
+    def test_truncated(self):
+        fn = os.path.join(self.workdir, "data.gz")
+        with open(fn, "wb") as fd:
+            fd.write(gzip.compress(b"line\n" * 100)[:-4])
+        with self.assertRaises(IOError):
+            list(memc_load.iter_gzip_blocks(fn))
+
+    def test_trailing_garbage(self):
+        fn = os.path.join(self.workdir, "data.gz")
+        with open(fn, "wb") as fd:
+            fd.write(gzip.compress(b"line\n") + b"\0\0garbage")
+        with self.assertRaises(zlib.error):
+            list(memc_load.iter_gzip_blocks(fn))
+
+
+class BackgroundTest(unittest.TestCase):
+    def source(self, count, error=None):
+        try:
+            for i in range(count):
+                yield b"%d" % i
+            if error:
+                raise error
+        finally:
+            self.closed.set()
+
+    def setUp(self):
+        self.closed = threading.Event()
+
+    def test_all_blocks(self):
+        self.assertEqual(list(memc_load.iter_background(self.source(5), maxsize=2)),
+                         [b"0", b"1", b"2", b"3", b"4"])
+        self.assertTrue(self.closed.is_set())
+
+    def test_error(self):
+        blocks = memc_load.iter_background(self.source(3, IOError("broken")), maxsize=1)
+        with self.assertRaisesRegex(IOError, "broken"):
+            list(blocks)
+        self.assertTrue(self.closed.is_set())
+
+    def test_consumer_stops_early(self):
+        blocks = memc_load.iter_background(self.source(1000), maxsize=1)
+        self.assertEqual(next(blocks), b"0")
+        blocks.close()
+        # the producer was blocked on the full queue, it stops and closes the source
+        self.assertTrue(self.closed.is_set())
+
+
+class ParseTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(
+            memc_load.parse_appsinstalled(b"idfa\tdev1\t55.55\t-42.5\t1,23,456"),
+            memc_load.AppsInstalled(b"idfa", b"dev1", 55.55, -42.5, [1, 23, 456]))
+
+    def test_padded_apps_and_extra_columns(self):
+        self.assertEqual(
+            memc_load.parse_appsinstalled(b"idfa\tdev1\t1\t2\t1, 2,3 \textra"),
+            memc_load.AppsInstalled(b"idfa", b"dev1", 1.0, 2.0, [1, 2, 3]))
+
+    def test_bad_apps_dropped(self):
+        with self.assertLogs(level="INFO") as logs:
+            appsinstalled = memc_load.parse_appsinstalled(b"idfa\tdev1\t1\t2\t1,x,-3,,4")
+        self.assertEqual(appsinstalled.apps, [1, 4])
+        self.assertEqual(logs.output, [
+            "INFO:root:Not all user apps are digits: `idfa\tdev1\t1\t2\t1,x,-3,,4`"])
+
+    def test_invalid(self):
+        for line in (b"idfa\tdev1\t1\t2", b"\tdev1\t1\t2\t3", b"idfa\t\t1\t2\t3"):
+            self.assertIsNone(memc_load.parse_appsinstalled(line))
+        with self.assertLogs(level="INFO") as logs:
+            self.assertIsNone(memc_load.parse_appsinstalled(b"idfa\tdev1\tlat\xff\t2\t3"))
+        self.assertEqual(logs.output, [
+            "INFO:root:Invalid geo coords: `idfa\tdev1\tlat\ufffd\t2\t3`"])
+
+
+class FakeMemcached:
+    """fake_memcached.py served from a thread of the test process"""
+
+    def __init__(self, failure_rate=0.0, latency=0.0):
+        self.store = {}
+        self.stats = dict.fromkeys(("curr_connections", "curr_items", "cmd_set", "cmd_get",
+                                    "get_hits", "get_misses"), 0)
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = self.call(self.loop.create_server(
+            lambda: fake_memcached.FakeMemcachedProtocol(self.store, self.stats, self.latency,
+                                                         self.failure_rate),
+            "127.0.0.1", 0))
+        self.addr = "127.0.0.1:%s" % self.server.sockets[0].getsockname()[1]
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(5)
+
+    def close(self):
+        self.server.close()
+        self.call(self.server.wait_closed())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def unused_addr():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "127.0.0.1:%s" % sock.getsockname()[1]
+
+
+class MemcWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.memc = FakeMemcached()
+        self.addCleanup(self.memc.close)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def make_writer(self, memc_addr, **kwargs):
+        kwargs.setdefault("batch_size", 10)
+        kwargs.setdefault("backoff", 0)
+        kwargs.setdefault("timeout", 1)
+        writer = memc_load.MemcWriter(memc_addr, **kwargs)
+        self.addCleanup(writer.memc.disconnect_all)
+        return writer
+
+    def test_batches(self):
+        writer = self.make_writer(self.memc.addr, batch_size=3)
+        for i in range(7):
+            writer.add(b"idfa:%d" % i, b"value")
+        writer.close()
+        self.assertEqual((writer.processed, writer.errors), (7, 0))
+        self.assertEqual(writer.sends, 3)
+        self.assertEqual(len(self.memc.store), 7)
+
+    def test_invalid_keys_dropped(self):
+        writer = self.make_writer(self.memc.addr)
+        for key in (b"idfa:1", b"idfa:bad key", b"idfa:" + b"x" * 250, b"idfa:2"):
+            writer.add(key, b"value")
+        writer.close()
+        self.assertEqual((writer.processed, writer.errors), (2, 2))
+        self.assertEqual(sorted(self.memc.store), [b"idfa:1", b"idfa:2"])
+        self.assertEqual(writer.breaker.failures, 0)
+
+    def test_retries(self):
+        memc = FakeMemcached(failure_rate=0.5)
+        self.addCleanup(memc.close)
+        writer = self.make_writer(memc.addr, retries=2)
+        # the first set fails with SERVER_ERROR, the rest succeed
+        outcomes = iter([0.0])
+        with patch.object(fake_memcached, "random") as rnd:
+            rnd.random.side_effect = lambda: next(outcomes, 1.0)
+            writer.add(b"idfa:1", b"value")
+            writer.add(b"idfa:2", b"value")
+            writer.close()
+        self.assertEqual((writer.processed, writer.errors), (2, 0))
+        self.assertEqual(writer.sends, 2)
+        self.assertEqual(memc.stats["cmd_set"], 3)
+        self.assertEqual(writer.breaker.failures, 0)
+
+    def test_breaker_opens_on_dead_node(self):
+        breaker = memc_load.CircuitBreaker("dead", threshold=2, reset_timeout=60)
+        writer = self.make_writer(unused_addr(), breaker=breaker, batch_size=1, retries=1)
+        with warnings.catch_warnings():
+            # python-memcached does not close sockets which failed to connect
+            warnings.simplefilter("ignore", ResourceWarning)
+            for i in range(4):
+                writer.add(b"idfa:%d" % i, b"value")
+            writer.close()
+            gc.collect()
+        self.assertEqual((writer.processed, writer.errors), (0, 4))
+        # two batches with a retry each, then the open breaker skips the network
+        self.assertEqual(writer.sends, 4)
+        self.assertIsNotNone(breaker.opened_at)
+
+    def test_breaker_probe(self):
+        breaker = memc_load.CircuitBreaker(self.memc.addr, threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        writer = self.make_writer(self.memc.addr, breaker=breaker, batch_size=1)
+        writer.add(b"idfa:1", b"value")
+        self.assertEqual((writer.processed, writer.errors, writer.sends), (0, 1, 0))
+        with patch.object(memc_load.time, "time", return_value=breaker.opened_at + 61):
+            writer.add(b"idfa:2", b"value")
+        writer.close()
+        self.assertEqual((writer.processed, writer.errors), (1, 1))
+        self.assertIsNone(breaker.opened_at)
+
+
+class AsyncMemcPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.memc = FakeMemcached()
+        self.addCleanup(self.memc.close)
+
+    def make_pool(self, memc_addr, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        kwargs.setdefault("timeout", 1)
+        pool = memc_load.AsyncMemcPool(memc_addr, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    async def test_set_many(self):
+        pool = self.make_pool(self.memc.addr)
+        with self.assertLogs(level="ERROR") as logs:
+            await pool.submit([(b"idfa:1", b"v1"), (b"idfa:bad key", b"v"),
+                               (b"idfa:" + b"x" * 250, b"v"), (b"idfa:2", b"v2")])
+            await pool.join()
+        self.assertEqual((pool.processed, pool.errors, pool.inflight), (2, 2, 0))
+        self.assertEqual(self.memc.store, {b"idfa:1": (b"0", b"v1"), b"idfa:2": (b"0", b"v2")})
+        self.assertIn("Skipping 2 invalid keys", logs.output[0])
+        self.assertEqual(pool.breaker.failures, 0)
+
+    async def test_retries(self):
+        memc = FakeMemcached(failure_rate=0.5)
+        self.addCleanup(memc.close)
+        pool = self.make_pool(memc.addr, retries=2)
+        outcomes = iter([0.0])
+        with patch.object(fake_memcached, "random") as rnd:
+            rnd.random.side_effect = lambda: next(outcomes, 1.0)
+            await pool.submit([(b"idfa:1", b"v"), (b"idfa:2", b"v")])
+            await pool.join()
+        self.assertEqual((pool.processed, pool.errors), (2, 0))
+        self.assertEqual((pool.sends, memc.stats["cmd_set"]), (2, 3))
+
+    async def test_breaker_opens_on_dead_node(self):
+        breaker = memc_load.CircuitBreaker("dead", threshold=1, reset_timeout=60)
+        pool = self.make_pool(unused_addr(), breaker=breaker, retries=1)
+        with self.assertLogs(level="ERROR"):
+            await pool.submit([(b"idfa:1", b"v")])
+            await pool.join()
+            await pool.submit([(b"idfa:2", b"v")])
+            await pool.join()
+        self.assertEqual((pool.processed, pool.errors), (0, 2))
+        # the first chunk is tried twice, the second is failed by the open breaker
+        self.assertEqual(pool.sends, 2)
+        self.assertIsNotNone(breaker.opened_at)
+
+    async def test_submit_does_not_wait_for_replies(self):
+        memc = FakeMemcached(latency=0.2)
+        self.addCleanup(memc.close)
+        pool = self.make_pool(memc.addr, size=1)
+        started = time.monotonic()
+        await pool.submit([(b"idfa:1", b"v")])
+        await pool.submit([(b"idfa:2", b"v")])
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(pool.inflight, 2)
+        # both slots of the only connection are taken, the third chunk waits
+        await pool.submit([(b"idfa:3", b"v")])
+        self.assertGreater(time.monotonic() - started, 0.15)
+        await pool.join()
+        self.assertEqual((pool.processed, pool.errors), (3, 0))
+
+    async def test_dry_run(self):
+        pool = self.make_pool(self.memc.addr, dry_run=True)
+        packed = memc_load.pack_user_apps([1, 2], 1.5, 2.5)
+        with self.assertLogs(level="DEBUG") as logs:
+            await pool.submit([(b"idfa:1", packed)])
+            await pool.join()
+        self.assertEqual((pool.processed, pool.errors), (1, 0))
+        self.assertEqual(logs.output, [
+            "DEBUG:root:%s - idfa:1 -> apps: 1 apps: 2 lat: 1.5 lon: 2.5 " % self.memc.addr])
+        self.assertEqual(self.memc.stats["cmd_set"], 0)
+
+
+SAMPLE_LINES = [
+    b"idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567,3,7,23",
+    b"gaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424",
+    b"adid\t5rfw452y52g2gq4g\t-1\t1\t1",
+    b"dvid\t4rfw452y52g2gq4g\t0\t0\t1,2",
+    b"bad line",
+]
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = patch("time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_snapshot(self):
+        progress = memc_load.FileProgress("a.tsv.gz")
+        first = SimpleNamespace(processed=0, errors=0, sends=0, send_time=0.0)
+        second = SimpleNamespace(processed=0, errors=0, sends=0, send_time=0.0)
+        idle = SimpleNamespace(processed=0, errors=0, sends=0, send_time=0.0)
+        # two writers of one address and a node nothing was sent to yet
+        progress.nodes = [("a:1", first, lambda: 3), ("a:1", second, lambda: 3),
+                          ("b:1", idle, lambda: 0)]
+        list(progress.track(iter([[b"ab", b"c"], [b"def"]])))
+        first.processed, first.sends, first.send_time = 6, 2, 0.1
+        second.processed, second.errors, second.sends, second.send_time = 2, 1, 2, 0.3
+        progress.bad = 1
+        self.now = 102.0
+        snapshot = progress.snapshot()
+        self.assertEqual((snapshot["lines"], snapshot["bytes"]), (3, 9))
+        self.assertEqual((snapshot["lines_per_sec"], snapshot["bytes_per_sec"]), (1.5, 4.5))
+        self.assertEqual((snapshot["processed"], snapshot["errors"]), (8, 2))
+        self.assertEqual(snapshot["error_rate"], 0.2)
+        self.assertEqual(snapshot["elapsed"], 2.0)
+        self.assertFalse(snapshot["done"])
+        # writers of an address share one queue
+        self.assertEqual(snapshot["nodes"]["a:1"]["queue"], 3)
+        self.assertAlmostEqual(snapshot["nodes"]["a:1"]["latency_ms"], 100.0)
+        self.assertIsNone(snapshot["nodes"]["b:1"]["latency_ms"])
+
+        # rates and latencies are over the time since the previous snapshot
+        list(progress.track(iter([[b"x"] * 4])))
+        first.sends, first.send_time = 3, 0.3
+        self.now = 106.0
+        snapshot = progress.snapshot(done=True)
+        self.assertEqual((snapshot["lines"], snapshot["bytes"]), (7, 17))
+        self.assertEqual((snapshot["lines_per_sec"], snapshot["bytes_per_sec"]), (1.0, 2.0))
+        self.assertAlmostEqual(snapshot["nodes"]["a:1"]["latency_ms"], 200.0)
+        self.assertIsNone(snapshot["nodes"]["b:1"]["latency_ms"])
+        self.assertEqual(snapshot["elapsed"], 6.0)
+        self.assertTrue(snapshot["done"])
+
+        # no sends since the previous snapshot
+        self.now = 107.0
+        snapshot = progress.snapshot()
+        self.assertIsNone(snapshot["nodes"]["a:1"]["latency_ms"])
+        self.assertEqual(snapshot["lines_per_sec"], 0.0)
+
+
+def make_snapshot(fn, done, **counters):
+    snapshot = {"file": fn, "done": done, "lines": 0, "bytes": 0, "processed": 0,
+                "errors": 0, "lines_per_sec": 0.0, "bytes_per_sec": 0.0}
+    snapshot.update(counters)
+    return snapshot
+
+
+class StatsFileWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, "stats.json")
+
+    def test_write(self):
+        snapshots = queue.Queue()
+        writer = memc_load.StatsFileWriter(self.path, snapshots)
+        replaced = []
+        os_replace = os.replace
+
+        def replace(src, dst):
+            # the new file is complete, the old one is still in place
+            with open(src) as fd:
+                new = json.load(fd)
+            old = None
+            if os.path.exists(dst):
+                with open(dst) as fd:
+                    old = json.load(fd)
+            replaced.append((src, dst, old, new))
+            os_replace(src, dst)
+
+        snapshots.put(make_snapshot("a", False, lines=10, bytes=100, lines_per_sec=5.0,
+                                    bytes_per_sec=50.0))
+        snapshots.put(make_snapshot("b", False, lines=4, bytes=40, processed=3, errors=1,
+                                    lines_per_sec=2.0, bytes_per_sec=20.0))
+        snapshots.put(make_snapshot("a", True, lines=20, bytes=200, processed=19, errors=1,
+                                    lines_per_sec=10.0, bytes_per_sec=100.0))
+        snapshots.put(None)
+        with patch("os.replace", replace):
+            writer.start()
+            writer.join(5)
+        self.assertFalse(writer.is_alive())
+
+        self.assertEqual(len(replaced), 3)
+        self.assertEqual({(src, dst) for src, dst, _, _ in replaced},
+                         {(self.path + ".tmp", self.path)})
+        self.assertIsNone(replaced[0][2])
+        self.assertEqual(replaced[1][2], replaced[0][3])
+        self.assertEqual(os.listdir(self.workdir), ["stats.json"])
+
+        with open(self.path) as fd:
+            stats = json.load(fd)
+        self.assertEqual(stats, replaced[-1][3])
+        self.assertEqual(sorted(stats["files"]), ["a", "b"])
+        self.assertEqual(stats["files"]["a"]["lines"], 20)
+        self.assertTrue(stats["files"]["a"]["done"])
+        # rates are summed over the files still being loaded
+        self.assertEqual(stats["total"], {
+            "lines": 24, "bytes": 240, "processed": 22, "errors": 2,
+            "lines_per_sec": 2.0, "bytes_per_sec": 20.0, "files_done": 1})
+        self.assertIsInstance(stats["updated"], float)
+
+
+class ProgressReporterTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def drain(self, stats):
+        snapshots = []
+        while not stats.empty():
+            snapshots.append(stats.get_nowait())
+        return snapshots
+
+    def test_stop(self):
+        stats = queue.Queue()
+        reporter = memc_load.ProgressReporter(
+            memc_load.FileProgress("a.tsv.gz"), interval=0.01, stats=stats)
+        reporter.start()
+        first = stats.get(timeout=5)
+        self.assertFalse(first["done"])
+        reporter.stop()
+        self.assertFalse(reporter.is_alive())
+        snapshots = self.drain(stats)
+        # the final snapshot goes last, nothing is reported after it
+        self.assertTrue(snapshots[-1]["done"])
+        self.assertFalse(any(snapshot["done"] for snapshot in snapshots[:-1]))
+        time.sleep(0.05)
+        self.assertTrue(stats.empty())
+
+    def test_stop_disabled(self):
+        stats = queue.Queue()
+        reporter = memc_load.ProgressReporter(
+            memc_load.FileProgress("a.tsv.gz"), interval=0, stats=stats)
+        reporter.start()
+        reporter.stop()
+        self.assertFalse(reporter.is_alive())
+        self.assertEqual([snapshot["done"] for snapshot in self.drain(stats)], [True])
+
+
+class ProcessFileTest(unittest.TestCase):
+    def setUp(self):
+        self.memc = FakeMemcached()
+        self.addCleanup(self.memc.close)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.addCleanup(setattr, memc_load, "memc_nodes", None)
+
+    def write_file(self, name, lines):
+        fn = os.path.join(self.workdir, name)
+        with gzip.open(fn, "wb") as fd:
+            fd.write(b"\n".join(lines) + b"\n")
+        return fn
+
+    def parse_options(self, *args):
+        addrs = ["--%s=%s" % (dev_type, self.memc.addr)
+                 for dev_type in ("idfa", "gaid", "adid", "dvid")]
+        options, _ = memc_load.build_option_parser().parse_args(
+            addrs + ["--decompressor=python", "--progress-interval=0"] + list(args))
+        return options
+
+    def test_writers_kept_between_files(self):
+        options = self.parse_options("--threads=2")
+        first = self.write_file("first.tsv.gz", SAMPLE_LINES)
+        second = self.write_file("second.tsv.gz", SAMPLE_LINES[:2])
+        self.assertEqual(memc_load.process_file(first, options), (4, 1))
+        threads = list(memc_load.memc_nodes.threads)
+        self.assertEqual(memc_load.process_file(second, options), (2, 0))
+        self.assertEqual(memc_load.memc_nodes.threads, threads)
+        self.assertTrue(all(thread.is_alive() for thread in threads))
+        self.assertEqual(len(self.memc.store), 4)
+        self.assertLessEqual(self.memc.stats["curr_connections"], 2)
+        memc_load.memc_nodes.close()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_empty_node_list(self):
+        options = self.parse_options("--idfa= , ", "--dvid=",
+                                     "--pattern=%s/*.tsv.gz" % self.workdir)
+        with patch("multiprocessing.Pool") as pool:
+            with self.assertRaisesRegex(ValueError, "for idfa, dvid$"):
+                memc_load.main(options)
+        pool.assert_not_called()
+
+    def test_rename_only_good_loads(self):
+        good = SAMPLE_LINES[:4]
+        for name, lines in (("a.tsv.gz", good), ("b.tsv.gz", good + [b"bad line"] * 2),
+                            ("c.tsv.gz", good)):
+            self.write_file(name, lines)
+        options = self.parse_options("--workers=2", "--pattern=%s/*.tsv.gz" % self.workdir)
+        memc_load.main(options)
+        self.assertEqual(sorted(os.listdir(self.workdir)), [".a.tsv.gz", "b.tsv.gz", "c.tsv.gz"])
+
+
+if __name__ == "__main__":
+    unittest.main()